@@ -16,9 +16,108 @@ from typing import Optional, Dict, Any
 # ===================== 配置项 =====================
 FIX_USER_ID = "stu1"
 FIX_SERVER_URL = "http://192.168.40.171:5000"
+STATUS_LONG_POLL_WAIT = 10  # 状态接口长轮询等待时间（秒），服务端在状态变化时立即返回；新提交的ID在登记时先立即查询一次
+ANALYSIS_WAIT_TIMEOUT = 120  # 等待单个分析完成的最长时间（秒）
 
 # ======================================================================================
 
+class StatusPoller:
+    """
+    状态轮询器：一个后台线程跟踪所有未完成的分析/执行ID，
+    每轮用一次批量长轮询请求查询全部ID（替代每次上传启动一个监控线程）
+    新登记的ID先立即查询一次，已完成的结果（如缓存命中）不必等当前这轮长轮询结束
+    （qwen4/vscode_auto_upload.py 中有同样的实现，修改时两处保持一致）
+    """
+    def __init__(self, server_url):
+        self.server_url = server_url
+        self.pending = {}  # id -> {"kind", "deadline", "status", "callback"}
+        self.condition = threading.Condition()
+        self.thread = None
+    
+    def track(self, item_id, kind, callback, timeout):
+        """
+        kind: "analysis" 或 "execution"
+        callback(item_id, status_data) 返回 True 表示已结束、不再跟踪；超时时 status_data 为 None
+        """
+        item = {
+            "kind": kind,
+            "deadline": time.time() + timeout,
+            "status": None,
+            "callback": callback
+        }
+        with self.condition:
+            self.pending[item_id] = item
+            self.condition.notify()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        # 立即查询一次（不等待），之后的状态变化由后台线程长轮询
+        data = self._query({item_id: item}, wait=0)
+        if data is not None:
+            self._apply(data)
+    
+    def _query(self, items, wait):
+        """批量查询状态，失败时返回 None"""
+        payload = {
+            "analysis_ids": [i for i, item in items.items() if item["kind"] == "analysis"],
+            "execution_ids": [i for i, item in items.items() if item["kind"] == "execution"],
+            "known": {i: item["status"] for i, item in items.items() if item["status"]}
+        }
+        try:
+            response = requests.post(
+                f"{self.server_url}/api/vscode/batch_status",
+                params={"wait": wait},
+                json=payload,
+                timeout=wait + 10
+            )
+            if not response.ok:
+                return None
+            return response.json()
+        except Exception:
+            return None
+    
+    def _apply(self, data):
+        """对状态有变化的ID调用回调；先记录新状态，避免两个线程重复回调同一状态"""
+        updates = list(data.get("analyses", {}).items()) + list(data.get("executions", {}).items())
+        for item_id, status_data in updates:
+            status = status_data.get("status")
+            with self.condition:
+                item = self.pending.get(item_id)
+                if item is None or status == item["status"]:
+                    continue
+                item["status"] = status
+            try:
+                done = item["callback"](item_id, status_data)
+            except Exception as e:
+                print(f"⚠️ 处理状态更新出错: {str(e)}")
+                done = True
+            if done:
+                with self.condition:
+                    if self.pending.get(item_id) is item:
+                        del self.pending[item_id]
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                now = time.time()
+                expired = [(item_id, item) for item_id, item in self.pending.items() if item["deadline"] <= now]
+                for item_id, _ in expired:
+                    del self.pending[item_id]
+                snapshot = dict(self.pending)
+            
+            for item_id, item in expired:
+                item["callback"](item_id, None)
+            if not snapshot:
+                continue
+            
+            data = self._query(snapshot, STATUS_LONG_POLL_WAIT)
+            if data is None:
+                time.sleep(2)
+                continue
+            self._apply(data)
+
 class PyCharmAutoUploadClient:
     def __init__(self, server_url=FIX_SERVER_URL, user_id=FIX_USER_ID):
         self.server_url = server_url
@@ -31,6 +130,7 @@ class PyCharmAutoUploadClient:
         self.UPLOAD_INTERVAL = 2
         self.last_run_files = set()
         self.run_file_expire = 5
+        self.status_poller = StatusPoller(server_url)
 
         # 创建日志目录
         self.log_dir = Path.home() / ".pycharm_auto_upload"
@@ -116,7 +216,7 @@ class PyCharmAutoUploadClient:
             message = result.get("message", "代码已上传，AI分析中...")
             print(f"✅ 上传成功 | {message} | 分析ID: {ana_id}")
 
-            threading.Thread(target=self.monitor_analysis_progress, args=(ana_id, filename), daemon=True).start()
+            self.monitor_analysis_progress(ana_id, filename)
             return ana_id
         except Exception as e:
             print(f"❌ 上传错误: {str(e)}")
@@ -124,26 +224,23 @@ class PyCharmAutoUploadClient:
             return None
 
     def monitor_analysis_progress(self, analysis_id, filename):
+        """登记到统一的状态轮询线程（所有上传共用一个线程、一个批量请求）"""
         print(f"⌛ 等待【{filename}】AI分析完成 (分析ID: {analysis_id})")
-        for _ in range(60):
-            time.sleep(2)
-            try:
-                res = requests.get(f"{self.server_url}/api/vscode/auto_status/{analysis_id}", timeout=5)
-                if res.status_code == 200:
-                    status_data = res.json()
-                    if status_data.get("status") == "completed":
-                        print(f"\n✅【{filename}】静态分析完成 ✔️")
-                        if status_data.get("result"):
-                            print(f"📊 分析结果: {status_data['result'].get('summary', '分析完成')}")
-                        break
-                    elif status_data.get("status") == "processing":
-                        print(f"🔄 【{filename}】分析中... (进度: {status_data.get('progress', '未知')})")
-                    else:
-                        print(f"⚠️ 【{filename}】分析状态: {status_data.get('status', '未知')}")
-            except Exception as e:
-                pass
 
-        print(f"\n📌 【{filename}】分析监听结束 (如需查看结果，可打开专属面板)")
+        def on_status(item_id, status_data):
+            if status_data is None:
+                print(f"\n📌 【{filename}】分析监听结束 (如需查看结果，可打开专属面板)")
+                return True
+            status = status_data.get("status")
+            if status == "completed":
+                print(f"\n✅【{filename}】静态分析完成 ✔️")
+                if status_data.get("analysis_preview"):
+                    print(f"📊 分析结果: {status_data['analysis_preview']}")
+                return True
+            print(f"⚠️ 【{filename}】分析状态: {status or '未知'}")
+            return status in ("failed", "skipped", "not_found")
+
+        self.status_poller.track(analysis_id, "analysis", on_status, ANALYSIS_WAIT_TIMEOUT)
 
     # ========== 核心改动1：新增运行py文件的方法 ==========
     def run_file_locally(self, file_path):
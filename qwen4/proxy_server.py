@@ -1,5 +1,6 @@
 from flask import Flask, send_from_directory, request, jsonify, Response
 import requests
+from requests.adapters import HTTPAdapter
 from flask_cors import CORS
 import socket
 import time
@@ -11,11 +12,24 @@ import threading
 import queue
 import re
 import os
+import random
+import logging
+import logging.handlers
 import watchdog
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import hashlib
+import difflib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps, cached_property
 import ast  # 新增：用于代码安全分析
+import sqlite3
+import atexit
+import io
+import textwrap
+import tokenize
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 CORS(app, 
@@ -35,58 +49,802 @@ os.makedirs(HTML_FOLDER, exist_ok=True)
 OLLAMA_BASE_URL = "http://127.0.0.1:11434"
 OLLAMA_CHAT_URL = f"{OLLAMA_BASE_URL}/api/chat"
 OLLAMA_MODEL_NAME = "qwen:7b-chat-q4_0"
+OLLAMA_SMALL_MODEL_NAME = os.environ.get("OLLAMA_SMALL_MODEL", "qwen:1.8b-chat-q4_0")
 
-# 分点输出提示词（让模型强制分点换行）
-POINT_PROMPT = "\n\n请用清晰的分点格式（序号1、2、3...或项目符号）回答，每个要点单独一行，确保易读性。"
+# 模型档位：各接口/触发类型使用的模型（保存触发的分析量最大，用小模型）
+MODEL_TIERS = {
+    "large": OLLAMA_MODEL_NAME,
+    "small": OLLAMA_SMALL_MODEL_NAME
+}
+MODEL_TIER_ROUTES = {
+    "chat": "large",
+    "analyze": "large",
+    "compare": "large",
+    "debug": "large",
+    "runtime": "small",
+    "auto_save": "small",
+    "auto_run": "small",
+    "auto_test": "large",
+    "auto_debug": "large"
+}
+MODEL_ESCALATION_ENABLED = True  # 小模型回答置信度低或调用失败时，改用大模型重新分析
 
-# ========== 代码安全性检查函数 ==========
-def validate_code_safety(code):
-    """检查代码安全性"""
-    # 禁止的危险模块
-    dangerous_modules = ['os', 'sys', 'subprocess', 'shutil', 'glob', 'importlib', '__builtins__']
-    
-    # 禁止的危险函数/属性访问
-    dangerous_calls = [
-        'eval', 'exec', 'compile', 'open', 'input',
-        '__import__', 'getattr', 'setattr', 'delattr',
-        'exit', 'quit', 'breakpoint'
+# 多个Ollama后端（逗号分隔，可用环境变量 OLLAMA_BACKENDS 覆盖），新增CPU机器时加到这里即可
+OLLAMA_BACKENDS = [url.strip().rstrip('/') for url in os.environ.get("OLLAMA_BACKENDS", OLLAMA_BASE_URL).split(',') if url.strip()]
+OLLAMA_HEALTH_CHECK_INTERVAL = 15  # 后端健康检查间隔（秒）
+OLLAMA_ANALYSIS_RETRIES = 2        # 非流式分析失败后换后端重试的次数
+OLLAMA_AFFINITY_SLACK = 2          # 会话固定后端比最空闲后端多出的排队数在此以内时保持不变
+
+# Ollama连接池配置（所有上游调用共用，避免每次请求新建TCP连接）
+OLLAMA_POOL_SIZE = 32            # 连接池保留的keep-alive连接数
+OLLAMA_MAX_CONCURRENCY = 8       # 同时发往Ollama的最大请求数
+OLLAMA_SLOT_WAIT_TIMEOUT = 30    # 等待空闲并发槽位的最长时间（秒）
+OLLAMA_CONNECT_TIMEOUT = 5       # 建立连接超时（秒）
+OLLAMA_CHAT_TIMEOUT = 60         # 聊天接口读取超时（秒）
+OLLAMA_ANALYSIS_TIMEOUT = 30     # 代码分析接口读取超时（秒）
+OLLAMA_KEEP_ALIVE = "30m"        # 模型及其KV缓存在Ollama中的保留时间
+
+# 模型预热与常驻：启动时预加载各档位模型，之后定期刷新 keep_alive，避免空闲后首个请求承担加载时间
+OLLAMA_WARMUP_MODELS = list(dict.fromkeys(MODEL_TIERS.values()))
+OLLAMA_WARMUP_REFRESH_INTERVAL = 600  # 刷新间隔（秒），需小于 OLLAMA_KEEP_ALIVE
+OLLAMA_WARMUP_TIMEOUT = 300           # 加载模型的读取超时（秒），冷启动加载7B模型可能超过1分钟
+
+# 分点输出提示词（作为固定的系统消息发送，让模型强制分点换行）
+POINT_PROMPT = "请用清晰的分点格式（序号1、2、3...或项目符号）回答，每个要点单独一行，确保易读性。"
+
+# ========== 结构化日志（队列 + 后台写线程） ==========
+# 请求线程只把日志放入队列；后台线程写JSON行文件（按大小轮转），并按需回显到控制台
+LOG_FILE = os.path.join("logs", "proxy_server.log")
+LOG_LEVEL = os.environ.get("PROXY_LOG_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = 10 * 1024 * 1024  # 单个日志文件上限
+LOG_BACKUP_COUNT = 5              # 轮转保留的旧文件数
+LOG_QUEUE_SIZE = 10000            # 队列满时丢弃新日志（并计数），不阻塞请求
+LOG_CONSOLE = True                # 同时在控制台输出（由写线程输出）
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+# 各类别 DEBUG/INFO 日志的采样率，未列出的为1；WARNING及以上不采样
+LOG_SAMPLE_RATES = {
+    "watcher": 0.2,
+    "markers": 0.1
+}
+
+class AsyncJsonLogger:
+    """非阻塞日志：log() 只做级别判断、采样和一次入队"""
+    def __init__(self, path=LOG_FILE, level=LOG_LEVEL):
+        self.path = path
+        self.level = LOG_LEVELS.get(level, 20)
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.counts = {"written": 0, "dropped": 0, "sampled_out": 0}
+        self.file_logger = None
+        self.thread = threading.Thread(target=self._writer, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def log(self, level, category, message, **fields):
+        level_no = LOG_LEVELS.get(level, 20)
+        if level_no < self.level:
+            return
+        rate = LOG_SAMPLE_RATES.get(category, 1.0)
+        if level_no < LOG_LEVELS["WARNING"] and rate < 1.0 and random.random() >= rate:
+            self.counts["sampled_out"] += 1
+            return
+        try:
+            self.queue.put_nowait((time.time(), level, category, message, fields))
+        except queue.Full:
+            self.counts["dropped"] += 1
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            self.path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        file_logger = logging.getLogger("proxy_server.jsonl")
+        file_logger.propagate = False
+        file_logger.setLevel(logging.DEBUG)
+        file_logger.addHandler(handler)
+        return file_logger
+
+    def _writer(self):
+        try:
+            self.file_logger = self._open()
+        except OSError as e:
+            print(f"⚠️ 无法打开日志文件 {self.path}: {str(e)}，仅输出到控制台")
+        while True:
+            timestamp, level, category, message, fields = self.queue.get()
+            when = datetime.fromtimestamp(timestamp)
+            if self.file_logger:
+                entry = {"time": when.isoformat(), "level": level, "category": category, "message": message}
+                entry.update(fields)
+                self.file_logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+            if LOG_CONSOLE:
+                print(f"[{when.strftime('%H:%M:%S')}] {message}")
+                if fields.get("traceback"):
+                    print(fields["traceback"], end="")
+            self.counts["written"] += 1
+
+    def stats(self):
+        return dict(self.counts, queued=self.queue.qsize(), level=self.level, file=self.path)
+
+app_logger = AsyncJsonLogger()
+
+def log_event(level, category, message, **fields):
+    app_logger.log(level, category, message, **fields)
+
+# ========== Ollama连接池客户端 ==========
+class OllamaBusyError(Exception):
+    """等待Ollama并发槽位超时"""
+    pass
+
+class OllamaClient:
+    """单个Ollama后端的HTTP客户端：连接池 + keep-alive + 并发上限 + 分次超时 + 健康状态"""
+    def __init__(self, base_url, pool_size=OLLAMA_POOL_SIZE, max_concurrency=OLLAMA_MAX_CONCURRENCY):
+        self.base_url = base_url
+        self.chat_url = f"{base_url}/api/chat"
+        self.max_concurrency = max_concurrency
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.outstanding = 0  # 已分配到本后端、尚未结束的请求数（含排队等待槽位的）
+        self.in_flight = 0
+        self.total_requests = 0
+        self.lock = threading.Lock()
+        # 健康检查结果
+        self.healthy = True
+        self.models = set()         # 已安装的模型
+        self.loaded_models = set()  # 当前已加载到内存的模型
+        self.last_check = None
+        self.last_error = None
+        # 模型预热记录：model -> {"last_load_seconds", "last_warmup", "error"}
+        self.residency = {}
+        self.warm_up_attempted_at = {}  # model -> 上次尝试预热的时间戳
+
+    def begin(self):
+        with self.lock:
+            self.outstanding += 1
+
+    def end(self):
+        with self.lock:
+            self.outstanding -= 1
+
+    def _acquire(self):
+        self.begin()
+        if not self.slots.acquire(timeout=OLLAMA_SLOT_WAIT_TIMEOUT):
+            self.end()
+            raise OllamaBusyError(f"Ollama并发请求已达上限({self.max_concurrency})，请稍后重试")
+        with self.lock:
+            self.in_flight += 1
+            self.total_requests += 1
+
+    def _release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+        self.end()
+
+    def chat(self, payload, timeout=OLLAMA_ANALYSIS_TIMEOUT):
+        """非流式调用：读完响应体后立即归还槽位，连接回到连接池"""
+        self._acquire()
+        try:
+            return self.session.post(
+                self.chat_url,
+                json=payload,
+                stream=False,
+                timeout=(OLLAMA_CONNECT_TIMEOUT, timeout)
+            )
+        finally:
+            self._release()
+
+    def stream_chat(self, payload, timeout=OLLAMA_CHAT_TIMEOUT):
+        """流式调用：槽位一直占用到 response.close() 被调用为止"""
+        self._acquire()
+        try:
+            response = self.session.post(
+                self.chat_url,
+                json=payload,
+                stream=True,
+                timeout=(OLLAMA_CONNECT_TIMEOUT, timeout)
+            )
+        except Exception:
+            self._release()
+            raise
+
+        released = threading.Event()
+        original_close = response.close
+
+        def close():
+            original_close()
+            if not released.is_set():
+                released.set()
+                self._release()
+
+        response.close = close
+        return response
+
+    def warm_up(self, model):
+        """
+        预加载模型并刷新 keep_alive（不带prompt的generate请求只加载模型，不生成内容）
+        模型已在内存中时几乎立即返回；耗时记录为最近一次加载延迟
+        """
+        record = self.residency.setdefault(model, {"last_load_seconds": None, "last_warmup": None, "error": None})
+        self.warm_up_attempted_at[model] = time.time()
+        if self.models and model not in self.models:
+            record["error"] = "模型未安装"
+            return False
+        start = time.time()
+        try:
+            self._acquire()
+            try:
+                response = self.session.post(
+                    f"{self.base_url}/api/generate",
+                    json={"model": model, "keep_alive": OLLAMA_KEEP_ALIVE},
+                    timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_WARMUP_TIMEOUT)
+                )
+            finally:
+                self._release()
+            response.raise_for_status()
+        except Exception as e:
+            record["error"] = str(e)
+            return False
+        record.update({
+            "last_load_seconds": round(time.time() - start, 2),
+            "last_warmup": datetime.now().isoformat(),
+            "error": None
+        })
+        self.loaded_models.add(model)
+        return True
+
+    def needs_warm_up(self, model):
+        """模型被Ollama卸载（健康检查发现不在 /api/ps 中）或到了刷新时间；上次失败的按刷新间隔重试"""
+        due = time.time() - self.warm_up_attempted_at.get(model, 0) >= OLLAMA_WARMUP_REFRESH_INTERVAL
+        if self.residency.get(model, {}).get("error"):
+            return due
+        return due or model not in self.loaded_models
+
+    def check_health(self):
+        """查询已安装和已加载的模型，失败则标记为不可用"""
+        try:
+            tags = self.session.get(f"{self.base_url}/api/tags", timeout=(OLLAMA_CONNECT_TIMEOUT, 5))
+            tags.raise_for_status()
+            self.models = {m.get("name") for m in tags.json().get("models", [])}
+            try:
+                ps = self.session.get(f"{self.base_url}/api/ps", timeout=(OLLAMA_CONNECT_TIMEOUT, 5))
+                self.loaded_models = {m.get("name") for m in ps.json().get("models", [])} if ps.status_code == 200 else set()
+            except requests.exceptions.RequestException:
+                self.loaded_models = set()
+            self.healthy = True
+            self.last_error = None
+        except Exception as e:
+            self.healthy = False
+            self.last_error = str(e)
+        self.last_check = datetime.now().isoformat()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "url": self.base_url,
+                "healthy": self.healthy,
+                "models": sorted(self.models),
+                "loaded_models": sorted(self.loaded_models),
+                "model_residency": {
+                    model: dict(record, loaded=model in self.loaded_models)
+                    for model, record in self.residency.items()
+                },
+                "last_check": self.last_check,
+                "last_error": self.last_error,
+                "pool_size": OLLAMA_POOL_SIZE,
+                "max_concurrency": self.max_concurrency,
+                "outstanding": self.outstanding,
+                "in_flight": self.in_flight,
+                "total_requests": self.total_requests
+            }
+
+class OllamaBackendPool:
+    """多个Ollama后端：健康检查 + 最少未完成请求路由"""
+    def __init__(self, base_urls):
+        self.backends = [OllamaClient(url) for url in base_urls]
+
+    def get(self, base_url):
+        for backend in self.backends:
+            if backend.base_url == base_url:
+                return backend
+        return None
+
+    def pick(self, model=None, exclude=(), preferred=None):
+        """选择未完成请求最少的可用后端；preferred（会话固定的后端）排队不明显更多时优先"""
+        candidates = [b for b in self.backends if b.healthy and b not in exclude]
+        if model:
+            # 健康检查尚未拿到模型列表时不做过滤
+            with_model = [b for b in candidates if not b.models or model in b.models]
+            if with_model:
+                candidates = with_model
+        if not candidates:
+            # 全部不可用时仍尝试一次，可能只是健康检查尚未恢复
+            candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+        
+        best = min(candidates, key=lambda b: b.outstanding)
+        if preferred in candidates and preferred.outstanding <= best.outstanding + OLLAMA_AFFINITY_SLACK:
+            return preferred
+        return best
+
+    def mark_failed(self, backend, error):
+        backend.healthy = False
+        backend.last_error = str(error)
+
+    def check_all(self):
+        for backend in self.backends:
+            backend.check_health()
+
+    def stats(self):
+        return [backend.stats() for backend in self.backends]
+
+ollama_pool = OllamaBackendPool(OLLAMA_BACKENDS)
+
+def ollama_health_loop():
+    """定期检查各Ollama后端"""
+    while True:
+        try:
+            ollama_pool.check_all()
+        except Exception as e:
+            log_event("WARNING", "ollama", f"Ollama健康检查出错: {str(e)}")
+        time.sleep(OLLAMA_HEALTH_CHECK_INTERVAL)
+
+def model_residency_loop():
+    """启动时预热各档位模型，之后定期刷新，模型被卸载时尽快重新加载"""
+    while True:
+        for backend in ollama_pool.backends:
+            if not backend.healthy:
+                continue
+            for model in OLLAMA_WARMUP_MODELS:
+                if not backend.needs_warm_up(model):
+                    continue
+                was_loaded = model in backend.loaded_models
+                if backend.warm_up(model):
+                    if not was_loaded:
+                        log_event("INFO", "warmup", f"🔥 模型已预热: {model} @ {backend.base_url} "
+                                  f"({backend.residency[model]['last_load_seconds']}s)")
+                else:
+                    log_event("WARNING", "warmup", f"⚠️ 模型预热失败: {model} @ {backend.base_url}: {backend.residency[model]['error']}")
+        time.sleep(OLLAMA_HEALTH_CHECK_INTERVAL)
+
+# ========== 模型调用优先级调度 ==========
+# 所有模型调用先在这里排队：交互聊天 > 手动分析 > 保存触发的自动分析 > 运行时分析
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_MANUAL = "manual"
+PRIORITY_AUTO_SAVE = "auto_save"
+PRIORITY_RUNTIME = "runtime"
+MODEL_PRIORITY_ORDER = [PRIORITY_INTERACTIVE, PRIORITY_MANUAL, PRIORITY_AUTO_SAVE, PRIORITY_RUNTIME]
+
+# 每个优先级的最大排队数，超过后直接返回429（按级别分开，自动分析排满不影响聊天）
+MODEL_QUEUE_MAX_DEPTH = {
+    PRIORITY_INTERACTIVE: 64,
+    PRIORITY_MANUAL: 32,
+    PRIORITY_AUTO_SAVE: 32,
+    PRIORITY_RUNTIME: 16
+}
+MODEL_QUEUE_WAIT_TIMEOUT = 120      # 排队最长等待时间（秒）
+MODEL_RESERVED_INTERACTIVE_SLOTS = 1  # 为交互聊天预留的槽位，其他级别不能占用
+
+class SchedulerFullError(Exception):
+    """模型调用队列已满或排队超时"""
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ModelScheduler:
+    """
+    模型调用准入队列：按优先级分级排队，同一级别内按用户轮转，
+    避免某个用户的大量请求挤占其他用户
+    """
+    def __init__(self, slots):
+        self.slots = slots
+        self.free = slots
+        self.cond = threading.Condition()
+        # 每个优先级：OrderedDict(user_id -> deque[ticket])，轮转时把用户移到末尾
+        self.queues = {priority: OrderedDict() for priority in MODEL_PRIORITY_ORDER}
+        self.depth = {priority: 0 for priority in MODEL_PRIORITY_ORDER}
+        self.granted = {priority: 0 for priority in MODEL_PRIORITY_ORDER}
+        self.rejected = {priority: 0 for priority in MODEL_PRIORITY_ORDER}
+        self.avg_hold_seconds = 10.0  # 单次调用平均占用时长（指数滑动平均），用于估算Retry-After
+
+    def _retry_after(self, priority):
+        waiting = sum(self.depth[p] for p in MODEL_PRIORITY_ORDER[:MODEL_PRIORITY_ORDER.index(priority) + 1])
+        return max(1, int(self.avg_hold_seconds * (waiting + 1) / max(1, self.slots)))
+
+    def _can_run(self, priority):
+        if priority == PRIORITY_INTERACTIVE:
+            return self.free > 0
+        return self.free > MODEL_RESERVED_INTERACTIVE_SLOTS or (
+            self.free > 0 and self.slots <= MODEL_RESERVED_INTERACTIVE_SLOTS)
+
+    def _dispatch(self):
+        """把空闲槽位按优先级、用户轮转分配给排队中的请求"""
+        for priority in MODEL_PRIORITY_ORDER:
+            user_queues = self.queues[priority]
+            while user_queues and self._can_run(priority):
+                user_id, tickets = next(iter(user_queues.items()))
+                ticket = tickets.popleft()
+                if tickets:
+                    user_queues.move_to_end(user_id)
+                else:
+                    del user_queues[user_id]
+                self.depth[priority] -= 1
+                self.free -= 1
+                self.granted[priority] += 1
+                ticket["granted"] = True
+                if ticket["on_grant"]:
+                    ticket["on_grant"]()
+        self.cond.notify_all()
+
+    def _enqueue(self, priority, user_id, on_grant=None):
+        """（持有锁时调用）能立即运行时占用槽位并返回 None，否则排队并返回票据"""
+        earlier_waiting = any(self.depth[p] for p in MODEL_PRIORITY_ORDER[:MODEL_PRIORITY_ORDER.index(priority) + 1])
+        if not earlier_waiting and self._can_run(priority):
+            self.free -= 1
+            self.granted[priority] += 1
+            return None
+        
+        if self.depth[priority] >= MODEL_QUEUE_MAX_DEPTH[priority]:
+            self.rejected[priority] += 1
+            raise SchedulerFullError("模型服务繁忙，请稍后重试", self._retry_after(priority))
+        
+        ticket = {"granted": False, "priority": priority, "user_id": user_id, "on_grant": on_grant}
+        self.queues[priority].setdefault(user_id, deque()).append(ticket)
+        self.depth[priority] += 1
+        return ticket
+
+    def _abandon(self, ticket):
+        """（持有锁时调用）排队超时，撤下票据，返回要抛出的异常"""
+        priority, user_id = ticket["priority"], ticket["user_id"]
+        tickets = self.queues[priority].get(user_id)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self.queues[priority][user_id]
+        self.depth[priority] -= 1
+        self.rejected[priority] += 1
+        return SchedulerFullError("模型服务排队超时，请稍后重试", self._retry_after(priority))
+
+    def acquire(self, priority, user_id, timeout=MODEL_QUEUE_WAIT_TIMEOUT):
+        """申请一个模型调用槽位，返回获得槽位的时间戳（传给release）"""
+        with self.cond:
+            ticket = self._enqueue(priority, user_id)
+            if ticket is None:
+                return time.time()
+            deadline = time.time() + timeout
+            while not ticket["granted"]:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise self._abandon(ticket)
+                self.cond.wait(remaining)
+            return time.time()
+
+    def enqueue(self, priority, user_id, on_grant):
+        """
+        非阻塞申请（供异步服务使用）：能立即运行时返回 None；
+        否则返回排队票据，分配到槽位时在调度线程中调用 on_grant()
+        """
+        with self.cond:
+            return self._enqueue(priority, user_id, on_grant)
+
+    def cancel(self, ticket, keep_if_granted=False):
+        """
+        放弃排队中的票据。票据已获得槽位时返回 True：keep_if_granted 为真则由调用方继续使用并release，
+        否则直接归还槽位；仍在排队时撤下票据，返回排队超时异常
+        """
+        with self.cond:
+            if ticket["granted"]:
+                if not keep_if_granted:
+                    self.free += 1
+                    self._dispatch()
+                return True
+            return self._abandon(ticket)
+
+    def release(self, granted_at):
+        with self.cond:
+            self.avg_hold_seconds = 0.9 * self.avg_hold_seconds + 0.1 * (time.time() - granted_at)
+            self.free += 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, priority, user_id):
+        granted_at = self.acquire(priority, user_id)
+        try:
+            yield
+        finally:
+            self.release(granted_at)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "slots": self.slots,
+                "free": self.free,
+                "queued": dict(self.depth),
+                "granted": dict(self.granted),
+                "rejected": dict(self.rejected),
+                "avg_hold_seconds": round(self.avg_hold_seconds, 2)
+            }
+
+model_scheduler = ModelScheduler(sum(b.max_concurrency for b in ollama_pool.backends))
+
+# ========== 按用户限流（令牌桶） ==========
+# 每个 (接口类别, 用户) 一个令牌桶：rate=每秒补充的令牌数, burst=桶容量
+RATE_LIMITS = {
+    "chat": {"rate": 0.5, "burst": 10},          # 聊天：平均每2秒1次
+    "analyze": {"rate": 0.2, "burst": 10},       # 手动分析/比较/调试
+    "auto_analyze": {"rate": 0.5, "burst": 20},  # IDE保存/运行触发的自动上传
+    "execute": {"rate": 0.1, "burst": 5}         # 沙箱执行：平均每10秒1次
+}
+RATE_LIMIT_IDLE_SECONDS = 3600  # 空闲超过此时长的令牌桶在定期清理时删除
+
+class RateLimiter:
+    """按 (接口类别, 用户) 的令牌桶限流器"""
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}  # (category, user_id) -> [tokens, last_refill]
+        self.lock = threading.Lock()
+        self.allowed = {category: 0 for category in limits}
+        self.rejected = {category: 0 for category in limits}
+        self.rejected_users = {}  # user_id -> 被拒绝次数
+
+    def try_acquire(self, category, user_id):
+        """消耗一个令牌，返回 (是否允许, 建议重试秒数)"""
+        limit = self.limits[category]
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get((category, user_id))
+            if bucket is None:
+                bucket = self.buckets[(category, user_id)] = [float(limit["burst"]), now]
+            bucket[0] = min(limit["burst"], bucket[0] + (now - bucket[1]) * limit["rate"])
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.allowed[category] += 1
+                return True, 0
+            self.rejected[category] += 1
+            self.rejected_users[user_id] = self.rejected_users.get(user_id, 0) + 1
+            return False, max(1, int((1 - bucket[0]) / limit["rate"] + 0.999))
+
+    def clean_idle(self):
+        now = time.time()
+        with self.lock:
+            for key in [k for k, b in self.buckets.items() if now - b[1] > RATE_LIMIT_IDLE_SECONDS]:
+                del self.buckets[key]
+
+    def stats(self):
+        with self.lock:
+            top_users = sorted(self.rejected_users.items(), key=lambda item: item[1], reverse=True)[:10]
+            return {
+                "limits": self.limits,
+                "allowed": dict(self.allowed),
+                "rejected": dict(self.rejected),
+                "top_rejected_users": dict(top_users),
+                "active_buckets": len(self.buckets)
+            }
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+def request_user_id():
+    """从请求体或查询参数中取 user_id，都没有时按客户端IP限流"""
+    data = request.get_json(silent=True) or {}
+    return data.get("user_id") or request.args.get("user_id") or request.remote_addr or "anonymous"
+
+def rate_limited(category):
+    """接口装饰器：在进行任何模型调用或沙箱执行之前检查令牌桶"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            allowed, retry_after = rate_limiter.try_acquire(category, request_user_id())
+            if not allowed:
+                response = jsonify({"error": "请求过于频繁，请稍后重试", "retry_after": retry_after})
+                response.headers["Retry-After"] = str(retry_after)
+                return response, 429
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def busy_response(error):
+    """队列已满时的429响应"""
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 429
+
+def ollama_error_response(error):
+    """流式分析连接Ollama失败时的响应（状态码与聊天接口一致）"""
+    if isinstance(error, OllamaBusyError):
+        return jsonify({"error": str(error)}), 503
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return jsonify({"error": "无法连接到 Ollama 服务，请检查 11434 端口是否运行"}), 503
+    return jsonify({"error": "Ollama 响应超时，请重试"}), 504
+
+# ========== 代码安全性检查（可配置策略，单次遍历） ==========
+# 默认策略；CODE_SAFETY_POLICY_FILE 存在时用其中的同名字段覆盖（JSON）
+CODE_SAFETY_POLICY_FILE = os.environ.get("CODE_SAFETY_POLICY", "code_safety_policy.json")
+CODE_SAFETY_POLICY = {
+    # 禁止导入的模块（模块路径中任一段命中即禁止，如 os.path、asyncio.subprocess），
+    # 能绕开 os/subprocess 执行命令或加载代码的底层模块也要逐个列出
+    "forbidden_modules": [
+        "os", "sys", "subprocess", "shutil", "glob", "importlib", "__builtins__", "builtins",
+        "posix", "nt", "_posixsubprocess", "_winapi", "pty", "ctypes", "_ctypes",
+        "multiprocessing", "_multiprocessing", "runpy", "code", "codeop"
+    ],
+    # 禁止直接调用的函数，如 eval(...)
+    "forbidden_calls": [
+        "eval", "exec", "compile", "open", "input",
+        "__import__", "getattr", "setattr", "delattr",
+        "exit", "quit", "breakpoint"
+    ],
+    # 禁止以属性方式调用的方法，如 obj.eval(...)
+    "forbidden_methods": [
+        "eval", "exec", "compile", "open", "input",
+        "__import__", "getattr", "setattr", "delattr",
+        "exit", "quit", "breakpoint",
+        "create_subprocess_exec", "create_subprocess_shell"  # asyncio 启动子进程
     ]
+}
+SAFETY_VERDICT_CACHE_SIZE = 2048  # 按代码哈希缓存的检查结果数量
+
+def load_safety_policy(path=CODE_SAFETY_POLICY_FILE):
+    """读取策略配置并编译成集合；返回 (策略, 来源)"""
+    policy = dict(CODE_SAFETY_POLICY)
+    source = "default"
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                overrides = json.load(f)
+            policy.update({key: overrides[key] for key in CODE_SAFETY_POLICY if key in overrides})
+            source = path
+        except (OSError, ValueError) as e:
+            log_event("WARNING", "safety", f"⚠️ 加载代码安全策略失败，使用默认策略: {str(e)}")
+    compiled = {key: frozenset(values) for key, values in policy.items()}
+    return compiled, source
+
+safety_policy, safety_policy_source = load_safety_policy()
+# 策略内容参与缓存key，修改策略后旧结论自然失效
+safety_policy_version = hashlib.sha256(
+    json.dumps({key: sorted(values) for key, values in safety_policy.items()}).encode('utf-8')
+).hexdigest()[:8]
+
+class SafetyPolicyVisitor(ast.NodeVisitor):
+    """一次遍历收集所有违规项 [{"line", "message"}]"""
+    def __init__(self, policy):
+        self.policy = policy
+        self.violations = []
+
+    def forbidden_module(self, name):
+        # 模块路径中任一段命中即禁止（如 asyncio.subprocess 命中 subprocess），
+        # 也支持在策略中写带点的名称（a.b 命中 a.b、a.b.c）
+        forbidden = self.policy["forbidden_modules"]
+        parts = name.split('.')
+        return (any(part in forbidden for part in parts)
+                or any('.'.join(parts[:i]) in forbidden for i in range(2, len(parts) + 1)))
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if self.forbidden_module(alias.name):
+                self.violations.append({"line": node.lineno, "message": f"禁止导入危险模块: {alias.name}"})
+
+    def visit_ImportFrom(self, node):
+        if node.module and self.forbidden_module(node.module):
+            self.violations.append({"line": node.lineno, "message": f"禁止从危险模块导入: {node.module}"})
+            return
+        # from asyncio import subprocess 这类导入的是子模块本身
+        for alias in node.names:
+            if self.forbidden_module(alias.name):
+                self.violations.append({"line": node.lineno, "message": f"禁止导入危险模块: {alias.name}"})
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in self.policy["forbidden_calls"]:
+            self.violations.append({"line": node.lineno, "message": f"禁止调用危险函数: {func.id}"})
+        elif isinstance(func, ast.Attribute) and func.attr in self.policy["forbidden_methods"]:
+            self.violations.append({"line": node.lineno, "message": f"禁止调用危险方法: {func.attr}"})
+        self.generic_visit(node)
+
+safety_verdicts = OrderedDict()  # 代码哈希 -> (是否安全, 说明)（LRU）
+safety_verdicts_lock = threading.Lock()
+safety_verdict_stats = {"hits": 0, "misses": 0}
+
+def cached_safety_verdict(content_hash):
+    """已有的检查结果；没有时返回 None"""
+    key = f"{safety_policy_version}:{content_hash}"
+    with safety_verdicts_lock:
+        verdict = safety_verdicts.get(key)
+        if verdict is None:
+            return None
+        safety_verdicts.move_to_end(key)
+        safety_verdict_stats["hits"] += 1
+        return verdict
+
+def store_safety_verdict(content_hash, verdict):
+    with safety_verdicts_lock:
+        safety_verdict_stats["misses"] += 1
+        safety_verdicts[f"{safety_policy_version}:{content_hash}"] = verdict
+        while len(safety_verdicts) > SAFETY_VERDICT_CACHE_SIZE:
+            safety_verdicts.popitem(last=False)
+
+def validate_code_safety(code, tree=None, content_hash=None):
+    """
+    检查代码安全性，报告所有违规项及行号；结果按代码哈希缓存
+    tree 为已解析的AST时不再重复解析
+    返回: (是否安全, 说明)
+    """
+    content_hash = content_hash or hashlib.sha256(code.encode('utf-8')).hexdigest()
+    verdict = cached_safety_verdict(content_hash)
+    if verdict is not None:
+        return verdict
     
-    # 尝试解析AST
     try:
-        tree = ast.parse(code)
-        
-        for node in ast.walk(tree):
-            # 检查导入
-            if isinstance(node, ast.Import):
-                for alias in node.names:
-                    if any(dm in alias.name for dm in dangerous_modules):
-                        return False, f"禁止导入危险模块: {alias.name}"
-                    
-            # 检查from...import
-            elif isinstance(node, ast.ImportFrom):
-                if node.module and any(dm in node.module for dm in dangerous_modules):
-                    return False, f"禁止从危险模块导入: {node.module}"
-                    
-            # 检查函数调用
-            elif isinstance(node, ast.Call):
-                if isinstance(node.func, ast.Name):
-                    if node.func.id in dangerous_calls:
-                        return False, f"禁止调用危险函数: {node.func.id}"
-                elif isinstance(node.func, ast.Attribute):
-                    if node.func.attr in dangerous_calls:
-                        return False, f"禁止调用危险方法: {node.func.attr}"
-                        
+        if tree is None:
+            tree = ast.parse(textwrap.dedent(code))  # 与 CodeArtifact.tree 相同的解析方式
+        visitor = SafetyPolicyVisitor(safety_policy)
+        visitor.visit(tree)
     except SyntaxError as e:
         # 语法错误，但允许执行（Python会自己报错）
-        return True, f"语法检查通过（语法错误会在执行时暴露: {str(e)}）"
+        verdict = (True, f"语法检查通过（语法错误会在执行时暴露: {str(e)}）")
     except Exception as e:
         return False, f"代码安全检查失败: {str(e)}"
+    else:
+        if visitor.violations:
+            verdict = (False, "；".join(f"第{v['line']}行 {v['message']}" for v in visitor.violations))
+        else:
+            verdict = (True, "代码安全检查通过")
     
-    return True, "代码安全检查通过"
+    store_safety_verdict(content_hash, verdict)
+    return verdict
+
+def code_safety_stats():
+    with safety_verdicts_lock:
+        return dict(safety_verdict_stats, size=len(safety_verdicts), policy=safety_policy_source,
+                    policy_version=safety_policy_version)
 
 # ========== 统一的聊天接口 ==========
+def build_chat_request(request_data):
+    """
+    解析聊天请求参数并构建Ollama请求（同步/异步两种服务模式共用）
+    会话模式：客户端只发送 session_id + message，历史由服务端保存并按token预算裁剪
+    返回: (历史记录key, 消息列表, Ollama请求)
+    """
+    # 提取参数
+    user_id = request_data.get("user_id", "default_user")
+    session_id = request_data.get("session_id")
+    if session_id and "message" in request_data:
+        history_key = session_id
+        messages = build_session_messages(session_id, request_data["message"])
+    else:
+        history_key = user_id
+        messages = request_data.get("messages", [])
+    stream = request_data.get("stream", True)  # 默认流式
+    temperature = request_data.get("temperature", 0.7)
+    max_tokens = request_data.get("max_tokens", 2048)
+    
+    # 分点提示词作为固定的系统消息放在最前面：用户消息原样发送、原样保存，
+    # 下一轮的消息前缀与本轮完全一致，才能复用Ollama的KV缓存
+    messages = [{"role": "system", "content": POINT_PROMPT}] + list(messages)
+    
+    # 构建Ollama请求
+    ollama_request = {
+        "model": model_for_route("chat"),
+        "messages": messages,
+        "stream": stream,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "keep_alive": OLLAMA_KEEP_ALIVE
+    }
+    return history_key, messages, ollama_request
+
+chat_backend_affinity = {}  # key=history_key, value=上次使用的后端地址（同一会话尽量落在同一后端以复用KV缓存）
+
+def pick_chat_backend(history_key, model=OLLAMA_MODEL_NAME):
+    """为聊天选择后端，保持会话与后端的亲和性"""
+    preferred = ollama_pool.get(chat_backend_affinity.get(history_key))
+    backend = ollama_pool.pick(model, preferred=preferred)
+    chat_backend_affinity[history_key] = backend.base_url
+    return backend
+
 @app.route('/api/chat', methods=['POST'])
+@rate_limited("chat")
 def chat_endpoint():
     """
     统一的聊天接口，支持流式和非流式响应
@@ -98,63 +856,50 @@ def chat_endpoint():
         if not request_data:
             return jsonify({"error": "请求数据为空"}), 400
         
-        # 2. 提取参数
-        user_id = request_data.get("user_id", "default_user")
-        messages = request_data.get("messages", [])
-        stream = request_data.get("stream", True)  # 默认流式
-        temperature = request_data.get("temperature", 0.7)
-        max_tokens = request_data.get("max_tokens", 2048)
-        
-        # 3. 给最后一条用户消息追加分点提示词
-        if messages and messages[-1]["role"] == "user":
-            messages[-1]["content"] += POINT_PROMPT
-        
-        # 4. 构建Ollama请求
-        ollama_request = {
-            "model": OLLAMA_MODEL_NAME,
-            "messages": messages,
-            "stream": stream,
-            "temperature": temperature,
-            "max_tokens": max_tokens
-        }
+        # 2-4. 提取参数并构建Ollama请求
+        history_key, messages, ollama_request = build_chat_request(request_data)
+        stream = ollama_request["stream"]
+        
+        backend = pick_chat_backend(history_key, ollama_request["model"])
         
         # 5. 流式响应处理
         if stream:
             try:
-                response = requests.post(
-                    OLLAMA_CHAT_URL,
-                    json=ollama_request,
-                    stream=True,
-                    timeout=60
-                )
+                granted_at = model_scheduler.acquire(PRIORITY_INTERACTIVE, history_key)
+                try:
+                    response = backend.stream_chat(ollama_request, timeout=OLLAMA_CHAT_TIMEOUT)
+                except Exception:
+                    model_scheduler.release(granted_at)
+                    raise
                 
                 def generate():
-                    assistant_reply = ""
-                    for chunk in response.iter_lines():
-                        if chunk:
-                            try:
-                                chunk_data = json.loads(chunk.decode('utf-8'))
-                                if chunk_data.get("message") and not chunk_data.get("done"):
-                                    content = chunk_data["message"].get("content", "")
-                                    assistant_reply += content
-                                    # 返回原始chunk保持兼容性
-                                    yield chunk + b'\n'
-                            except json.JSONDecodeError:
-                                # 如果不是JSON，直接返回
-                                yield chunk + b'\n'
-                            except Exception:
-                                yield chunk + b'\n'
+                    # 直通中转：原样转发上游字节，逐token不做JSON解析
+                    raw_parts = []
+                    try:
+                        for chunk in response.iter_content(chunk_size=None):
+                            if chunk:
+                                raw_parts.append(chunk)
+                                yield chunk
+                    finally:
+                        # 归还连接、并发槽位和调度槽位（客户端提前断开时也会执行）
+                        response.close()
+                        model_scheduler.release(granted_at)
                     
-                    # 保存对话历史（异步）
+                    # 流结束后一次性解析回复并保存对话历史（异步）
                     threading.Thread(
-                        target=save_conversation_history,
-                        args=(user_id, messages[-1]["content"].replace(POINT_PROMPT, ""), assistant_reply),
+                        target=save_streamed_reply,
+                        args=(history_key, messages, raw_parts),
                         daemon=True
                     ).start()
                 
                 return Response(generate(), mimetype="application/json")
                 
-            except requests.exceptions.ConnectionError:
+            except SchedulerFullError as e:
+                return busy_response(e)
+            except OllamaBusyError as e:
+                return jsonify({"error": str(e)}), 503
+            except requests.exceptions.ConnectionError as e:
+                ollama_pool.mark_failed(backend, e)
                 return jsonify({"error": "无法连接到 Ollama 服务，请检查 11434 端口是否运行"}), 503
             except requests.exceptions.Timeout:
                 return jsonify({"error": "Ollama 响应超时，请重试"}), 504
@@ -162,46 +907,142 @@ def chat_endpoint():
         # 6. 非流式响应处理
         else:
             try:
-                response = requests.post(
-                    OLLAMA_CHAT_URL,
-                    json=ollama_request,
-                    stream=False,
-                    timeout=60
-                )
+                with model_scheduler.slot(PRIORITY_INTERACTIVE, history_key):
+                    response = backend.chat(ollama_request, timeout=OLLAMA_CHAT_TIMEOUT)
                 
                 if response.status_code == 200:
                     result = response.json()
                     assistant_reply = result.get("message", {}).get("content", "")
+                    record_prompt_eval(history_key, messages, result, assistant_reply)
                     
                     # 保存对话历史
-                    save_conversation_history(
-                        user_id, 
-                        messages[-1]["content"].replace(POINT_PROMPT, ""), 
-                        assistant_reply
-                    )
+                    save_conversation_history(history_key, messages[-1]["content"], assistant_reply)
                     
                     return jsonify({
                         "response": assistant_reply,
-                        "model": OLLAMA_MODEL_NAME,
+                        "model": ollama_request["model"],
                         "done": True
                     }), 200
                 else:
                     return jsonify({"error": f"Ollama 服务错误: {response.status_code}"}), response.status_code
                     
-            except requests.exceptions.ConnectionError:
+            except SchedulerFullError as e:
+                return busy_response(e)
+            except OllamaBusyError as e:
+                return jsonify({"error": str(e)}), 503
+            except requests.exceptions.ConnectionError as e:
+                ollama_pool.mark_failed(backend, e)
                 return jsonify({"error": "无法连接到 Ollama 服务"}), 503
             except requests.exceptions.Timeout:
                 return jsonify({"error": "Ollama 响应超时"}), 504
     
     except Exception as e:
-        print(f"聊天接口错误：{str(e)}")
-        traceback.print_exc()
+        log_event("ERROR", "chat", f"聊天接口错误：{str(e)}", traceback=traceback.format_exc())
         return jsonify({"error": f"服务器内部错误：{str(e)}"}), 500
 
 # ========== 对话历史管理 ==========
-conversation_history = {}  # key=user_id, value=[{"role": ..., "content": ..., "time": ...}]
+conversation_history = {}  # key=user_id（会话模式为session_id）, value=[{"role": ..., "content": ..., "time": ...}]
 MAX_HISTORY_ROUNDS = 20    # 最多保留20轮对话
 MAX_HISTORY_AGE = 3600     # 1小时后自动过期
+CHAT_SESSION_TOKEN_BUDGET = 3000  # 会话模式下发给模型的历史token上限
+CHAT_SESSION_TRIM_RATIO = 0.5     # 超出预算时一次裁剪到预算的一半，之后若干轮前缀保持不变
+
+# 会话状态：key=session_id, value={"anchor": 保留历史的起始时间}
+# 保持消息前缀稳定，Ollama 才能复用上一轮已计算的KV缓存，只评估新增部分
+chat_session_state = {}
+
+# Ollama返回的prompt评估统计，用于观察前缀缓存带来的节省
+# 只用Ollama返回的真实计数：本轮实际评估的prompt token（prompt_eval_count）与生成的token（eval_count）
+prompt_eval_stats = {
+    "turns": 0,
+    "evaluated_prompt_tokens": 0,
+    "generated_tokens": 0,
+    "continued_turns": 0,       # 消息前缀与上一轮（含上一轮回复）完全一致的轮数
+    "reused_prompt_tokens": 0,  # 这些轮中未重新评估的上一轮上下文token
+    "prompt_eval_ms": 0.0
+}
+# key=history_key, value={"prefix": 上一轮消息+回复的哈希, "length": 消息条数, "context_tokens": 上一轮结束时的上下文token数}
+prompt_eval_sessions = {}
+prompt_eval_lock = threading.Lock()
+
+def hash_messages(messages):
+    return hashlib.sha256(json.dumps(
+        [[msg["role"], msg["content"]] for msg in messages], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def estimate_tokens(text):
+    """粗略估算token数：中文等非ASCII字符约1字1token，ASCII约4字符1token"""
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return non_ascii + (len(text) - non_ascii) // 4 + 1
+
+def build_session_messages(session_id, user_message, token_budget=CHAT_SESSION_TOKEN_BUDGET):
+    """
+    会话模式：从服务端历史中取出本会话的消息，再追加本轮用户消息
+    超出token预算时从最早的消息开始成批裁剪，并记住新的起点，
+    这样后续几轮发送的前缀完全一致，可命中Ollama的KV缓存
+    """
+    history = list(conversation_history.get(session_id, []))
+    state = chat_session_state.setdefault(session_id, {"anchor": None})
+    if state["anchor"] is not None:
+        history = [msg for msg in history if msg["time"] >= state["anchor"]]
+    
+    costs = [estimate_tokens(msg["content"]) for msg in history]
+    total = sum(costs) + estimate_tokens(user_message)
+    if total > token_budget:
+        target = token_budget * CHAT_SESSION_TRIM_RATIO
+        while history and total > target:
+            total -= costs.pop(0)
+            history.pop(0)
+        # 裁剪后第一条应为用户消息，避免以孤立的助手回复开头
+        while history and history[0]["role"] == "assistant":
+            costs.pop(0)
+            history.pop(0)
+        state["anchor"] = history[0]["time"] if history else datetime.now()
+    
+    selected = [{"role": msg["role"], "content": msg["content"]} for msg in history]
+    selected.append({"role": "user", "content": user_message})
+    return selected
+
+def record_prompt_eval(history_key, messages, final_frame, assistant_reply):
+    """
+    根据done帧的真实计数统计前缀复用：本轮消息以上一轮的 消息+回复 开头时，
+    上一轮结束时的上下文（其prompt token + 生成token）都可复用，
+    复用量 = 上一轮上下文 + 新消息 - 本轮实际评估的token（新消息token数为估算，只影响这一小部分）
+    """
+    evaluated = final_frame.get("prompt_eval_count")
+    if evaluated is None:
+        return
+    generated = final_frame.get("eval_count", 0)
+    with prompt_eval_lock:
+        previous = prompt_eval_sessions.get(history_key)
+        reused = 0
+        continued = (previous is not None and len(messages) > previous["length"]
+                     and hash_messages(messages[:previous["length"]]) == previous["prefix"])
+        if continued:
+            new_tokens = sum(estimate_tokens(msg["content"]) for msg in messages[previous["length"]:])
+            reused = max(0, min(previous["context_tokens"], previous["context_tokens"] + new_tokens - evaluated))
+            prompt_eval_stats["continued_turns"] += 1
+            prompt_eval_stats["reused_prompt_tokens"] += reused
+        prompt_eval_stats["turns"] += 1
+        prompt_eval_stats["evaluated_prompt_tokens"] += evaluated
+        prompt_eval_stats["generated_tokens"] += generated
+        prompt_eval_stats["prompt_eval_ms"] += final_frame.get("prompt_eval_duration", 0) / 1e6
+        full = messages + [{"role": "assistant", "content": assistant_reply}]
+        prompt_eval_sessions[history_key] = {
+            "prefix": hash_messages(full),
+            "length": len(full),
+            "context_tokens": reused + evaluated + generated
+        }
+
+def get_prompt_cache_stats():
+    """前缀缓存复用情况（供 /api/health 展示）"""
+    with prompt_eval_lock:
+        stats = dict(prompt_eval_stats)
+    reused = stats["reused_prompt_tokens"]
+    total = reused + stats["evaluated_prompt_tokens"]
+    stats["reused_ratio"] = round(reused / total, 3) if total else 0.0
+    stats["prompt_eval_ms"] = round(stats["prompt_eval_ms"], 1)
+    stats["sessions"] = len(chat_session_state)
+    return stats
 
 def save_conversation_history(user_id, user_message, assistant_reply):
     """保存对话历史"""
@@ -230,7 +1071,34 @@ def save_conversation_history(user_id, user_message, assistant_reply):
             conversation_history[user_id] = history[-MAX_HISTORY_ROUNDS * 2:]
             
     except Exception as e:
-        print(f"保存对话历史失败: {str(e)}")
+        log_event("WARNING", "chat", f"保存对话历史失败: {str(e)}")
+
+def parse_ndjson_reply(raw_parts):
+    """
+    将中转过程中收集的原始字节一次性拼接并解析
+    返回: (完整回复文本, 最后的done帧)
+    """
+    contents = []
+    final_frame = {}
+    for line in b"".join(raw_parts).split(b"\n"):
+        if not line.strip():
+            continue
+        try:
+            chunk_data = json.loads(line)
+        except ValueError:
+            continue
+        if chunk_data.get("done"):
+            final_frame = chunk_data
+        message = chunk_data.get("message")
+        if message:
+            contents.append(message.get("content", ""))
+    return "".join(contents), final_frame
+
+def save_streamed_reply(user_id, messages, raw_parts):
+    """流式回复结束后解析并保存对话历史"""
+    assistant_reply, final_frame = parse_ndjson_reply(raw_parts)
+    record_prompt_eval(user_id, messages, final_frame, assistant_reply)
+    save_conversation_history(user_id, messages[-1]["content"], assistant_reply)
 
 def clean_expired_history():
     """清理过期对话历史"""
@@ -243,182 +1111,218 @@ def clean_expired_history():
             conversation_history[user_id] = valid_history
         else:
             del conversation_history[user_id]
+            chat_session_state.pop(user_id, None)
+            chat_backend_affinity.pop(user_id, None)
+            with prompt_eval_lock:
+                prompt_eval_sessions.pop(user_id, None)
 
-def extract_code_between_markers(code_content, start_marker="#***start***#", end_marker="#***end***#"):
-    """增强版的代码提取函数"""
-    print(f" 开始提取代码，内容长度: {len(code_content)}")
-    print(f" 查找标签: [{start_marker}] 和 [{end_marker}]")
-    
-    # 调试：显示前几行和后几行
-    print("代码内容预览:")
-    lines = code_content.split('\n')
-    for i, line in enumerate(lines[:10]):
-        print(f"  行{i}: '{line}'")
-    if len(lines) > 10:
-        print(f"  ... (省略{len(lines)-10}行)")
-        for i, line in enumerate(lines[-5:], start=len(lines)-5):
-            print(f"  行{i}: '{line}'")
-    
-    # 方法1：使用字符串查找（更灵活）
-    start_idx = code_content.find(start_marker)
-    end_idx = code_content.find(end_marker)
-    
-    if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-        # 找到两个标记
-        start_idx += len(start_marker)
-        extracted = code_content[start_idx:end_idx].strip()
-        print(f"方法1：成功提取代码，长度: {len(extracted)}")
-        print(f"提取内容前200字符: {extracted[:200]}")
-        return extracted
-    else:
-        print(f"方法1：未找到标记或标记顺序错误")
-        print(f"  开始标记位置: {start_idx}")
-        print(f"  结束标记位置: {end_idx}")
-    
-    # 方法2：使用行遍历（备份方案）
-    print("🔄 尝试方法2：行遍历提取")
-    in_target_section = False
-    target_lines = []
-    exact_matches_found = 0
-    
-    for i, line in enumerate(lines):
-        # 检查是否包含精确标记（去除前后空格）
-        stripped = line.strip()
-        
-        # 检查开始标记
-        if start_marker in stripped:
-            print(f" 行{i} 找到开始标记: '{stripped}'")
-            exact_matches_found += 1
-            in_target_section = True
-            continue
-        
-        # 检查结束标记
-        if end_marker in stripped:
-            print(f" 行{i} 找到结束标记: '{stripped}'")
-            exact_matches_found += 1
-            in_target_section = False
-            break
-        
-        # 如果在目标区域内，保存代码
-        if in_target_section:
-            target_lines.append(line)
-    
-    result = '\n'.join(target_lines).strip()
-    print(f" 方法2提取结果:")
-    print(f"  找到的标记数量: {exact_matches_found}")
-    print(f"  提取行数: {len(target_lines)}")
-    print(f"  结果长度: {len(result)}")
-    
-    if result:
-        print(f" 提取内容预览:")
-        lines_preview = result.split('\n')
-        for i, line in enumerate(lines_preview[:10]):
-            print(f"  行{i}: {line}")
-        if len(lines_preview) > 10:
-            print(f"  ... (还有{len(lines_preview)-10}行)")
-    else:
-        print(" 未提取到任何内容")
-        
-        # 尝试查找可能的标记变体
-        print(" 搜索可能的标记变体:")
-        for i, line in enumerate(lines):
-            if 'start' in line.lower() or 'end' in line.lower():
-                print(f"  行{i} 可能包含标记: '{line.strip()}'")
+# ========== 标记区域扫描（单次遍历，支持多个区域） ==========
+CODE_START_MARKER = "#***start***#"
+CODE_END_MARKER = "#***end***#"
+
+def scan_marker_regions(code_content, start_marker=CODE_START_MARKER, end_marker=CODE_END_MARKER):
+    """
+    单次遍历找出所有 开始/结束 标记对（文件保存时每次都会调用，不输出任何日志）
+    返回: {
+        "regions": [{"code", "start_line", "end_line", "start_offset", "end_offset"}],
+            # 行号为标记所在行（从1开始），offset 为标记之间内容的UTF-8字节偏移
+        "start_count", "end_count",      # 找到的开始/结束标记数量
+        "unmatched_start", "unmatched_end"  # 没有配对的标记数量
+    }
+    """
+    regions = []
+    start_count = end_count = unmatched_start = unmatched_end = 0
+    open_region = None  # 当前未闭合区域: (起始行, 字符偏移, 字节偏移)
+    char_offset = byte_offset = 0
     
-    return result
+    for line_no, line in enumerate(code_content.splitlines(keepends=True), start=1):
+        pos = 0
+        while True:
+            marker = end_marker if open_region else start_marker
+            col = line.find(marker, pos)
+            other_col = line.find(start_marker if open_region else end_marker, pos)
+            if col == -1 and other_col == -1:
+                break
+            if col == -1 or (other_col != -1 and other_col < col):
+                # 区域内重复的开始标记 / 区域外多余的结束标记
+                if open_region:
+                    start_count += 1
+                    unmatched_start += 1
+                    pos = other_col + len(start_marker)
+                else:
+                    end_count += 1
+                    unmatched_end += 1
+                    pos = other_col + len(end_marker)
+                continue
+            
+            marker_char = char_offset + col
+            marker_byte = byte_offset + len(line[:col].encode('utf-8'))
+            if open_region is None:
+                start_count += 1
+                open_region = (line_no, marker_char + len(start_marker), marker_byte + len(start_marker.encode('utf-8')))
+            else:
+                end_count += 1
+                region_line, region_char, region_byte = open_region
+                regions.append({
+                    "code": code_content[region_char:marker_char].strip(),
+                    "start_line": region_line,
+                    "end_line": line_no,
+                    "start_offset": region_byte,
+                    "end_offset": marker_byte
+                })
+                open_region = None
+            pos = col + len(marker)
+        char_offset += len(line)
+        byte_offset += len(line.encode('utf-8'))
+    
+    if open_region:
+        unmatched_start += 1
+    return {
+        "regions": regions,
+        "start_count": start_count,
+        "end_count": end_count,
+        "unmatched_start": unmatched_start,
+        "unmatched_end": unmatched_end
+    }
 
 # ========== 智能标签检测函数 ==========
-def smart_detect_markers(code_content, start_marker="#***start***#", end_marker="#***end***#"):
+def smart_detect_markers(code_content, start_marker=CODE_START_MARKER, end_marker=CODE_END_MARKER):
     """
     智能检测代码中的标签
     返回: {
         "found_markers": True/False,  # 是否找到完整标签对
         "is_valid_snippet": True/False,  # 是否提取到有效代码片段
-        "extracted_code": "",  # 提取的代码
+        "extracted_code": "",  # 提取的代码（多个区域用空行连接）
+        "regions": [],  # 每个非空区域的代码和位置，见 scan_marker_regions
         "marker_count": 0,  # 找到的标签数量
         "message": "",  # 检测结果消息
         "original_length": len(code_content),
         "extracted_length": 0
     }
     """
-    print(f" 智能检测开始，代码长度: {len(code_content)}")
-    
-    # 检查是否包含标记
-    has_start_marker = start_marker in code_content
-    has_end_marker = end_marker in code_content
-    
-    # 情况1：完全没有标记
-    if not has_start_marker and not has_end_marker:
-        print(f"❌ 未检测到任何标记")
-        return {
-            "found_markers": False,
-            "is_valid_snippet": False,
-            "extracted_code": "",
-            "marker_count": 0,
-            "message": "❌ 未检测到标记 #***start***# 和 #***end***#",
-            "original_length": len(code_content),
-            "extracted_length": 0
-        }
-    
-    # 情况2：只有部分标记
-    if has_start_marker ^ has_end_marker:  # 异或，只有一个标记
-        missing_marker = end_marker if has_start_marker else start_marker
-        print(f"⚠️ 只检测到部分标记，缺少: {missing_marker}")
-        return {
-            "found_markers": False,
-            "is_valid_snippet": False,
-            "extracted_code": "",
-            "marker_count": 1,
-            "message": f"⚠️ 只检测到部分标记，请同时添加 {start_marker} 和 {end_marker}",
-            "original_length": len(code_content),
-            "extracted_length": 0
-        }
-    
-    # 情况3：有完整标记对，尝试提取
-    print(f"✅ 检测到完整标记对")
-    
-    # 使用字符串查找提取
-    start_idx = code_content.find(start_marker)
-    end_idx = code_content.find(end_marker)
-    
-    if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-        start_idx += len(start_marker)
-        extracted_code = code_content[start_idx:end_idx].strip()
-        
-        if extracted_code:
-            print(f"✅ 成功提取代码片段，长度: {len(extracted_code)}")
-            return {
-                "found_markers": True,
-                "is_valid_snippet": True,
-                "extracted_code": extracted_code,
-                "marker_count": 2,
-                "message": "✅ 成功检测并提取代码片段",
-                "original_length": len(code_content),
-                "extracted_length": len(extracted_code)
-            }
-        else:
-            print(f"⚠️ 标记间没有代码内容")
-            return {
-                "found_markers": True,
-                "is_valid_snippet": False,
-                "extracted_code": "",
-                "marker_count": 2,
-                "message": "⚠️ 检测到标记但标记之间没有代码内容",
-                "original_length": len(code_content),
-                "extracted_length": 0
-            }
-    
-    # 情况4：标记顺序错误
-    print(f"❌ 标记顺序错误")
-    return {
+    scan = scan_marker_regions(code_content, start_marker, end_marker)
+    marker_count = scan["start_count"] + scan["end_count"]
+    regions = [region for region in scan["regions"] if region["code"]]
+    result = {
         "found_markers": False,
         "is_valid_snippet": False,
         "extracted_code": "",
-        "marker_count": 2,
-        "message": "❌ 标记顺序错误，请确保 #***start***# 在 #***end***# 之前",
+        "regions": regions,
+        "marker_count": marker_count,
+        "message": "",
         "original_length": len(code_content),
         "extracted_length": 0
     }
+    
+    if marker_count == 0:
+        # 情况1：完全没有标记
+        result["message"] = f"❌ 未检测到标记 {start_marker} 和 {end_marker}"
+    elif not scan["start_count"] or not scan["end_count"]:
+        # 情况2：只有部分标记
+        result["message"] = f"⚠️ 只检测到部分标记，请同时添加 {start_marker} 和 {end_marker}"
+    elif not scan["regions"]:
+        # 情况4：标记顺序错误
+        result["message"] = f"❌ 标记顺序错误，请确保 {start_marker} 在 {end_marker} 之前"
+    elif not regions:
+        result["found_markers"] = True
+        result["message"] = "⚠️ 检测到标记但标记之间没有代码内容"
+    else:
+        # 情况3：有完整标记对且有代码
+        extracted_code = "\n\n".join(region["code"] for region in regions)
+        result.update({
+            "found_markers": True,
+            "is_valid_snippet": True,
+            "extracted_code": extracted_code,
+            "extracted_length": len(extracted_code),
+            "message": "✅ 成功检测并提取代码片段" if len(regions) == 1
+                       else f"✅ 成功检测并提取 {len(regions)} 个代码片段"
+        })
+    return result
+
+# ========== 代码制品（每份提交只解析一次） ==========
+# 同一份代码的哈希、标记检测、AST、安全检查和静态指标只计算一次，各接口和后台任务共用
+CODE_ARTIFACT_CACHE_SIZE = 256  # 按内容哈希缓存的制品数量
+
+class CodeArtifact:
+    """一份提交的代码及其派生结果，各属性首次访问时计算并保留（只读，不要修改返回的字典）"""
+    def __init__(self, text, content_hash):
+        self.text = text
+        self.content_hash = content_hash  # 原始文本的sha256
+        self.parse_error = None
+
+    @property
+    def short_id(self):
+        """用于分析/执行ID的短哈希"""
+        return self.content_hash[:8]
+
+    @cached_property
+    def detection(self):
+        """默认标记的检测结果，见 smart_detect_markers"""
+        return smart_detect_markers(self.text)
+
+    @property
+    def regions(self):
+        return self.detection["regions"]
+
+    @cached_property
+    def target(self):
+        """标记区域内代码的制品；没有有效区域时为 None"""
+        if not self.detection["is_valid_snippet"]:
+            return None
+        return get_code_artifact(self.detection["extracted_code"])
+
+    @cached_property
+    def tree(self):
+        """AST；无法解析时为 None，错误保存在 parse_error"""
+        try:
+            return ast.parse(textwrap.dedent(self.text))  # 标记之间的代码可能带缩进
+        except SyntaxError as e:
+            self.parse_error = e
+            return None
+
+    @cached_property
+    def safety(self):
+        """(是否安全, 说明)，见 validate_code_safety；已有结论时不解析AST"""
+        verdict = cached_safety_verdict(self.content_hash)
+        if verdict is not None:
+            return verdict
+        return validate_code_safety(self.text, self.tree, self.content_hash)
+
+    @cached_property
+    def static_metrics(self):
+        tree = self.tree
+        return compute_static_metrics(self.text, tree, self.parse_error)
+
+    @cached_property
+    def units(self):
+        """顶层函数/类单元，见 split_code_units；无法解析时为 None"""
+        if self.tree is None:
+            return None
+        return split_code_units(self.text, self.tree)
+
+code_artifacts = OrderedDict()  # 内容哈希 -> CodeArtifact（LRU）
+code_artifacts_lock = threading.Lock()
+code_artifact_stats = {"hits": 0, "misses": 0}
+
+def get_code_artifact(code):
+    """按内容哈希取得代码制品，不存在时新建"""
+    content_hash = hashlib.sha256(code.encode('utf-8')).hexdigest()
+    with code_artifacts_lock:
+        artifact = code_artifacts.get(content_hash)
+        if artifact is not None:
+            code_artifacts.move_to_end(content_hash)
+            code_artifact_stats["hits"] += 1
+            return artifact
+        code_artifact_stats["misses"] += 1
+        artifact = CodeArtifact(code, content_hash)
+        code_artifacts[content_hash] = artifact
+        while len(code_artifacts) > CODE_ARTIFACT_CACHE_SIZE:
+            code_artifacts.popitem(last=False)
+        return artifact
+
+def code_artifact_cache_stats():
+    with code_artifacts_lock:
+        return dict(code_artifact_stats, size=len(code_artifacts), max_size=CODE_ARTIFACT_CACHE_SIZE)
 
 # ========== 代码分析配置 ==========
 CODE_ANALYSIS_PROMPTS = {
@@ -455,6 +1359,44 @@ CODE_ANALYSIS_PROMPTS = {
     代码B：
     {code_b}""",
     
+    "comparison_diff": """以下是同一文件上一版本到当前版本的统一diff（只包含修改处及少量上下文），请比较两个版本：
+    1. **修改内容**：改了什么
+    2. **行为变化**：修改后程序行为有何不同
+    3. **性能差异**：
+    4. **可读性对比**：
+    5. **风险与建议**：修改可能引入的问题
+    
+    文件：{filename}
+    {diff}""",
+    
+    "explain_unit": """请简要分析以下{kind} `{name}`，按以下格式回答：
+    1. **功能**：它做什么
+    2. **实现要点**：关键逻辑和数据流
+    3. **复杂度**：时间/空间复杂度
+    4. **潜在问题**：可能的错误或改进点
+    
+    代码：
+    {code}""",
+    
+    "explain_chunk": """以下是一个较大程序的第{index}/{total}部分，请简要说明：
+    1. **功能**：这部分做什么
+    2. **关键逻辑**：主要流程和数据结构
+    3. **复杂度**：时间/空间复杂度
+    4. **潜在问题**：可能的错误或改进点
+    
+    代码：
+    {code}""",
+    
+    "explain_reduce": """以下是对同一个程序各部分的分析摘要，请综合成对整个程序的分析，按以下格式回答：
+    1. **主要功能**：简要说明代码的主要目的
+    2. **工作原理**：解释代码的执行流程
+    3. **关键模块**：指出代码中的关键部分
+    4. **复杂度分析**：评估时间复杂度和空间复杂度
+    5. **潜在问题**：指出可能存在的问题或改进空间
+    
+    各部分分析：
+    {summaries}""",
+    
     "debug": """请帮我调试以下代码问题：
     1. **错误原因**：分析错误产生的根本原因
     2. **解决方案**：提供具体的修复方案
@@ -473,6 +1415,356 @@ CODE_ANALYSIS_PROMPTS = {
     {stack_trace}"""
 }
 
+# 提示词模板版本：修改 CODE_ANALYSIS_PROMPTS 后需递增，使旧的缓存结果失效
+CODE_ANALYSIS_PROMPT_VERSION = 2
+
+# ========== 代码分析结果缓存（内容寻址，持久化到磁盘） ==========
+ANALYSIS_CACHE_FILE = os.path.join("cache", "analysis_cache.json")
+ANALYSIS_CACHE_MAX_ENTRIES = 2000      # 最多缓存条数（LRU淘汰）
+ANALYSIS_CACHE_TTL = 7 * 24 * 3600     # 缓存有效期（秒）
+ANALYSIS_CACHE_FLUSH_INTERVAL = 30     # 有新结果时后台写盘的间隔（秒），退出时再写一次
+
+def normalize_code_for_cache(code):
+    """统一换行、去掉行尾空白和首尾空行，避免无意义的差异导致缓存未命中"""
+    lines = code.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip('\n')
+
+class AnalysisCache:
+    """按 (分析类型, 提示词版本, 模型, 代码哈希) 缓存模型分析结果，LRU + TTL + 条数上限"""
+    def __init__(self, path=ANALYSIS_CACHE_FILE, max_entries=ANALYSIS_CACHE_MAX_ENTRIES, ttl=ANALYSIS_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, created)
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.dirty = False  # 有未写盘的修改
+        self.load()
+        # put() 只标记修改，由后台线程定期整体写盘，不在请求/工作线程上做磁盘IO
+        threading.Thread(target=self._flush_loop, name="analysis-cache-flush", daemon=True).start()
+        atexit.register(self.flush)
+
+    def make_key(self, analysis_type, code, model=None):
+        code_hash = hashlib.sha256(normalize_code_for_cache(code).encode('utf-8')).hexdigest()
+        return f"{analysis_type}:v{CODE_ANALYSIS_PROMPT_VERSION}:{model or OLLAMA_MODEL_NAME}:{code_hash}"
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None and time.time() - item[1] > self.ttl:
+                del self.entries[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def contains(self, key):
+        """只判断是否存在且未过期，不计入命中统计、不调整LRU顺序"""
+        with self.lock:
+            item = self.entries.get(key)
+            return item is not None and time.time() - item[1] <= self.ttl
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self.dirty = True
+
+    def flush(self):
+        """有未写盘的修改时写盘"""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+        self.save()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(ANALYSIS_CACHE_FLUSH_INTERVAL)
+            self.flush()
+
+    def load(self):
+        """启动时从磁盘恢复缓存（跳过已过期条目）"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                records = json.load(f)
+            now = time.time()
+            for key, value, created in records[-self.max_entries:]:
+                if now - created <= self.ttl:
+                    self.entries[key] = (value, created)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log_event("WARNING", "cache", f"⚠️ 加载分析缓存失败: {str(e)}")
+
+    def save(self):
+        """原子写入磁盘：先写临时文件再替换"""
+        with self.lock:
+            records = [[key, value, created] for key, (value, created) in self.entries.items()]
+        with self.save_lock:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                temp_path = self.path + ".tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(records, f, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                log_event("WARNING", "cache", f"⚠️ 保存分析缓存失败: {str(e)}")
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+                "evictions": self.evictions,
+                "pending_flush": self.dirty
+            }
+
+analysis_cache = AnalysisCache()
+
+# ========== 相同分析请求合并（single-flight） ==========
+class SingleFlight:
+    """同一key的调用同时只执行一次，其余调用等待并共享同一结果"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> {"event", "result", "error"}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                is_leader = False
+            else:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+                is_leader = True
+        
+        if not is_leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["event"].set()
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": len(self.calls), "coalesced": self.coalesced}
+
+analysis_flights = SingleFlight()
+
+# ========== 模型档位（小模型分流 + 低置信度升级） ==========
+# 小模型回答末尾要求给出置信度，便于判断是否需要升级到大模型
+MODEL_CONFIDENCE_INSTRUCTION = "\n\n    最后单独一行写出你对以上分析的置信度，格式为“置信度：高/中/低”。"
+MODEL_CONFIDENCE_PATTERN = re.compile(r'\n?\s*[*#>\s]*置信度\s*[:：]\s*\**\s*(高|中|低)\**\s*$')
+LOW_CONFIDENCE_MARKERS = ("不确定", "无法确定", "无法判断", "不太清楚", "信息不足")
+
+model_tier_stats = {"calls": {}, "escalations": 0}
+model_tier_stats_lock = threading.Lock()
+
+def model_for_route(route):
+    """按接口/触发类型取模型名，未配置的按大模型处理"""
+    return MODEL_TIERS.get(MODEL_TIER_ROUTES.get(route, "large"), OLLAMA_MODEL_NAME)
+
+def split_confidence(content):
+    """去掉末尾的置信度行，返回: (正文, 置信度；没有写明时为None)"""
+    match = MODEL_CONFIDENCE_PATTERN.search(content)
+    if not match:
+        return content, None
+    return content[:match.start()].rstrip(), match.group(1)
+
+def is_low_confidence(content, confidence):
+    if confidence is not None:
+        return confidence == "低"
+    return len(content) < 80 or any(marker in content for marker in LOW_CONFIDENCE_MARKERS)
+
+def get_model_tier_stats():
+    with model_tier_stats_lock:
+        return {
+            "routes": {route: model_for_route(route) for route in MODEL_TIER_ROUTES},
+            "calls": dict(model_tier_stats["calls"]),
+            "escalations": model_tier_stats["escalations"],
+            "escalation_enabled": MODEL_ESCALATION_ENABLED
+        }
+
+def request_model_analysis(prompt, analysis_type, cache_code=None, priority=PRIORITY_MANUAL, user_id="anonymous", model=None):
+    """
+    调用大模型完成一次分析，所有代码分析类调用的统一入口
+    cache_code 不为 None 时按其内容查询/写入分析缓存，并合并正在进行中的相同请求
+    priority/user_id 决定在模型调度队列中的位置，队列满时抛出 SchedulerFullError
+    model 为小模型时，回答置信度低或调用失败会自动用大模型重新分析
+    返回: (是否成功, 分析内容或错误信息)
+    """
+    model = model or OLLAMA_MODEL_NAME
+    if model == OLLAMA_MODEL_NAME:
+        return _request_model_analysis(prompt, analysis_type, cache_code, priority, user_id, model)
+    
+    error = None
+    try:
+        success, content = _request_model_analysis(
+            prompt + MODEL_CONFIDENCE_INSTRUCTION, analysis_type, cache_code, priority, user_id, model)
+    except (OllamaBusyError, requests.exceptions.RequestException) as e:
+        # 连接失败/超时/后端忙同样视为调用失败，升级到大模型；队列满（SchedulerFullError）照常抛出
+        error = e
+        success, content = False, f"模型调用失败: {str(e)}"
+    confidence = None
+    if success:
+        content, confidence = split_confidence(content)
+    if error is not None and not MODEL_ESCALATION_ENABLED:
+        raise error
+    if MODEL_ESCALATION_ENABLED and (not success or is_low_confidence(content, confidence)):
+        with model_tier_stats_lock:
+            model_tier_stats["escalations"] += 1
+        log_event("INFO", "analyze", f"⬆️ 小模型{'置信度低' if success else '调用失败'}，升级到 {OLLAMA_MODEL_NAME}: {analysis_type}")
+        return _request_model_analysis(prompt, analysis_type, cache_code, priority, user_id, OLLAMA_MODEL_NAME)
+    return success, content
+
+def _request_model_analysis(prompt, analysis_type, cache_code, priority, user_id, model):
+    cache_key = analysis_cache.make_key(analysis_type, cache_code, model) if cache_code is not None else None
+    if cache_key is None:
+        return _call_model_for_analysis(prompt, None, priority, user_id, model)
+    
+    cached = analysis_cache.get(cache_key)
+    if cached is not None:
+        return True, cached
+    return analysis_flights.do(cache_key, lambda: _call_model_for_analysis(prompt, cache_key, priority, user_id, model))
+
+def _call_model_for_analysis(prompt, cache_key, priority, user_id, model=OLLAMA_MODEL_NAME):
+    with model_tier_stats_lock:
+        model_tier_stats["calls"][model] = model_tier_stats["calls"].get(model, 0) + 1
+    with model_scheduler.slot(priority, user_id):
+        return _call_model_with_failover(prompt, cache_key, model)
+
+def _call_model_with_failover(prompt, cache_key, model=OLLAMA_MODEL_NAME):
+    """非流式分析是幂等的：某个后端连接失败、超时或返回5xx时换一个后端重试"""
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE
+    }
+    tried = []
+    last_error = None
+    for attempt in range(OLLAMA_ANALYSIS_RETRIES + 1):
+        backend = ollama_pool.pick(model, exclude=tried)
+        if backend is None:
+            break
+        tried.append(backend)
+        try:
+            response = backend.chat(payload, timeout=OLLAMA_ANALYSIS_TIMEOUT)
+        except OllamaBusyError as e:
+            last_error = e
+            continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            ollama_pool.mark_failed(backend, e)
+            last_error = e
+            continue
+        
+        if response.status_code >= 500:
+            last_error = f"模型调用失败: {response.status_code}"
+            continue
+        if response.status_code != 200:
+            return False, f"模型调用失败: {response.status_code}"
+        
+        content = response.json().get("message", {}).get("content", "")
+        if not content:
+            return False, "分析失败"
+        if cache_key:
+            analysis_cache.put(cache_key, content)
+        return True, content
+    
+    if isinstance(last_error, Exception):
+        raise last_error
+    return False, last_error or "没有可用的 Ollama 后端"
+
+# ========== 运行时关键点触发（按执行批量、去抖） ==========
+# 输出行命中以下关键字时记为关键点；模式只编译一次
+RUNTIME_TRIGGER_KEYWORDS = ['result:', 'output:', 'finished', 'done', 'error:', 'exception:', 'warning:']
+RUNTIME_TRIGGER_PATTERN = re.compile("|".join(re.escape(k) for k in RUNTIME_TRIGGER_KEYWORDS), re.IGNORECASE)
+RUNTIME_ANALYSIS_MAX_BATCHES = 3    # 每次执行最多发起的运行时分析次数
+RUNTIME_ANALYSIS_DEBOUNCE = 2.0     # 第一个关键点出现后等待多久再合并发送（秒）
+RUNTIME_BATCH_MAX_POINTS = 20       # 每批最多携带的不同关键点数
+
+class RuntimeTriggerCollector:
+    """收集一次执行中的关键输出点，去重合并后按批发起运行时分析"""
+    def __init__(self, code, user_id):
+        self.code = code
+        self.user_id = user_id
+        self.points = OrderedDict()  # 输出行 -> 出现次数（相同的行只保留一条）
+        self.batch_started = None
+        self.recent_output = ""
+        self.batches_sent = 0
+        self.dropped_points = 0
+
+    def feed(self, output, all_output):
+        """每行输出调用一次，命中关键字时记录"""
+        if not RUNTIME_TRIGGER_PATTERN.search(output):
+            return
+        if self.batches_sent >= RUNTIME_ANALYSIS_MAX_BATCHES:
+            self.dropped_points += 1
+            return
+        if output in self.points:
+            self.points[output] += 1
+        elif len(self.points) < RUNTIME_BATCH_MAX_POINTS:
+            self.points[output] = 1
+        else:
+            self.dropped_points += 1
+        if self.batch_started is None:
+            self.batch_started = time.time()
+        self.recent_output = "\n".join(all_output[-10:])  # 最近10行
+
+    def maybe_flush(self):
+        """去抖时间已到则发送当前批次"""
+        if self.batch_started is not None and time.time() - self.batch_started >= RUNTIME_ANALYSIS_DEBOUNCE:
+            self.flush()
+
+    def flush(self):
+        if not self.points or self.batches_sent >= RUNTIME_ANALYSIS_MAX_BATCHES:
+            return
+        self.batches_sent += 1
+        context = {
+            "output": "\n".join(self.points),
+            "key_points": [{"output": line, "count": count} for line, count in self.points.items()],
+            "code_snippet": self.code[:500],
+            "execution_point": f"关键输出阶段（第{self.batches_sent}批）",
+            "all_output": self.recent_output,
+            "user_id": self.user_id,
+            "timestamp": time.time()
+        }
+        self.points = OrderedDict()
+        self.batch_started = None
+        
+        # 异步进行分析
+        threading.Thread(
+            target=analyze_runtime_point,
+            args=(context,),
+            daemon=True
+        ).start()
+
 # 代码执行队列和状态跟踪
 code_execution_queue = queue.Queue()
 execution_results = {}
@@ -484,7 +1776,8 @@ def execute_code_with_monitoring(code, timeout=30, user_id="anonymous"):
     process = None
     
     # 1. 安全检查
-    is_safe, safety_msg = validate_code_safety(code)
+    artifact = get_code_artifact(code)
+    is_safe, safety_msg = artifact.safety
     if not is_safe:
         return {
             "success": False,
@@ -500,7 +1793,7 @@ def execute_code_with_monitoring(code, timeout=30, user_id="anonymous"):
             temp_dir = "temp_execution"
             os.makedirs(temp_dir, exist_ok=True)
             
-            temp_filename = f'{temp_dir}/temp_code_{hashlib.md5(code.encode()).hexdigest()[:8]}.py'
+            temp_filename = f'{temp_dir}/temp_code_{artifact.short_id}.py'
             with open(temp_filename, 'w', encoding='utf-8') as f:
                 f.write("# 安全沙箱执行代码\n")
                 f.write("# 自动生成的安全封装\n")
@@ -525,6 +1818,7 @@ def execute_code_with_monitoring(code, timeout=30, user_id="anonymous"):
             
             # 4. 读取输出
             start_time = time.time()
+            runtime_triggers = RuntimeTriggerCollector(code, user_id)
             while True:
                 if process.poll() is not None:
                     # 进程已结束，读取剩余输出
@@ -532,6 +1826,8 @@ def execute_code_with_monitoring(code, timeout=30, user_id="anonymous"):
                     if remaining_stdout:
                         stdout_lines.append(remaining_stdout.strip())
                         all_output.append(remaining_stdout.strip())
+                        for line in remaining_stdout.splitlines():
+                            runtime_triggers.feed(line, all_output)
                     break
                 
                 # 读取一行输出
@@ -541,23 +1837,9 @@ def execute_code_with_monitoring(code, timeout=30, user_id="anonymous"):
                     stdout_lines.append(output)
                     all_output.append(output)
                     
-                    # 检测关键输出点
-                    if any(keyword in output.lower() for keyword in ['result:', 'output:', 'finished', 'done', 'error:', 'exception:', 'warning:']):
-                        context = {
-                            "output": output,
-                            "code_snippet": code[:500],
-                            "execution_point": "关键输出阶段",
-                            "all_output": "\n".join(all_output[-10:]),  # 最近10行
-                            "user_id": user_id,
-                            "timestamp": time.time()
-                        }
-                        
-                        # 异步进行分析
-                        threading.Thread(
-                            target=analyze_runtime_point,
-                            args=(context,),
-                            daemon=True
-                        ).start()
+                    # 检测关键输出点（合并后按批分析）
+                    runtime_triggers.feed(output, all_output)
+                runtime_triggers.maybe_flush()
                 
                 # 超时检查
                 if time.time() - start_time > timeout:
@@ -569,6 +1851,9 @@ def execute_code_with_monitoring(code, timeout=30, user_id="anonymous"):
             if stderr_output:
                 stderr_lines.append(stderr_output.strip())
             
+            # 发送剩余的关键点
+            runtime_triggers.flush()
+            
             # 6. 确保进程终止
             if process.poll() is None:
                 process.terminate()
@@ -582,6 +1867,8 @@ def execute_code_with_monitoring(code, timeout=30, user_id="anonymous"):
                 "stderr": "\n".join(stderr_lines),
                 "returncode": process.returncode,
                 "output": "\n".join(all_output),
+                "runtime_analyses_sent": runtime_triggers.batches_sent,
+                "runtime_points_dropped": runtime_triggers.dropped_points,
                 "safety_check": True
             }
             
@@ -608,83 +1895,681 @@ def execute_code_with_monitoring(code, timeout=30, user_id="anonymous"):
     thread.start()
     thread.join(timeout + 5)  # 额外5秒缓冲
     
-    if thread.is_alive():
-        # 超时处理
-        try:
-            if process:
-                process.terminate()
-                time.sleep(1)
-                if process.poll() is None:
-                    process.kill()
-        except:
-            pass
-        
-        thread.join(2)  # 等待线程结束
-        
-        return {
-            "success": False,
-            "timeout": True,
-            "error": f"代码执行超时（{timeout}秒）",
-            "safety_check": True
-        }
+    if thread.is_alive():
+        # 超时处理
+        try:
+            if process:
+                process.terminate()
+                time.sleep(1)
+                if process.poll() is None:
+                    process.kill()
+        except:
+            pass
+        
+        thread.join(2)  # 等待线程结束
+        
+        return {
+            "success": False,
+            "timeout": True,
+            "error": f"代码执行超时（{timeout}秒）",
+            "safety_check": True
+        }
+    
+    return result_queue.get()
+
+def extract_code_blocks(text):
+    """从文本中提取代码块（如果需要支持Markdown格式）"""
+    code_pattern = r'```(?:\w+)?\s*([\s\S]*?)```'
+    matches = re.findall(code_pattern, text, re.MULTILINE)
+    
+    if matches:
+        return matches
+    else:
+        # 如果没有Markdown代码块，返回原始文本
+        return [text]
+
+# ========== 本地静态指标（AST计算，不调用模型） ==========
+# 增加圈复杂度的分支节点
+CYCLOMATIC_BRANCH_NODES = (ast.If, ast.For, ast.AsyncFor, ast.While, ast.IfExp,
+                           ast.ExceptHandler, ast.Assert, ast.comprehension)
+LOG_LOOP_OPERATORS = (ast.FloorDiv, ast.Div, ast.RShift, ast.Mult, ast.LShift)
+HALVING_OPERATORS = (ast.FloorDiv, ast.RShift)
+
+def cyclomatic_complexity(node):
+    complexity = 1
+    for child in ast.walk(node):
+        if isinstance(child, CYCLOMATIC_BRANCH_NODES):
+            complexity += 1
+            if isinstance(child, ast.comprehension):
+                complexity += len(child.ifs)
+        elif isinstance(child, ast.BoolOp):
+            complexity += len(child.values) - 1
+    return complexity
+
+def loop_growth(node):
+    """
+    估计单个循环的增长方式：
+    "1" 常量次数（如 range(100)），"log" 每次按倍数缩小/放大，"n" 其余情况
+    """
+    if isinstance(node, (ast.For, ast.AsyncFor, ast.comprehension)):
+        it = node.iter
+        if (isinstance(it, ast.Call) and isinstance(it.func, ast.Name) and it.func.id == "range"
+                and it.args and all(isinstance(arg, ast.Constant) for arg in it.args)):
+            return "1"
+        if isinstance(it, (ast.List, ast.Tuple, ast.Set, ast.Constant)):
+            return "1"
+        return "n"
+    for child in ast.walk(node):
+        # n //= 2 这类按倍数变化，或 (lo + hi) // 2 这类二分
+        if isinstance(child, ast.AugAssign) and isinstance(child.op, LOG_LOOP_OPERATORS):
+            return "log"
+        if isinstance(child, ast.BinOp) and isinstance(child.op, HALVING_OPERATORS):
+            return "log"
+    return "n"
+
+def loop_profile(node, depth=0):
+    """
+    返回: (最大循环嵌套深度, 最坏路径上的(n次数, log次数))
+    嵌套的函数/类单独统计，不计入外层
+    """
+    max_depth, worst = depth, (0, 0)
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+            continue
+        if isinstance(child, (ast.For, ast.AsyncFor, ast.While)):
+            growth = loop_growth(child)
+            child_depth, child_worst = loop_profile(child, depth + 1)
+        elif isinstance(child, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+            # 推导式的每个 for 子句都是一层循环
+            child_depth, child_worst = loop_profile(child, depth + len(child.generators))
+            for generator in child.generators:
+                growth = loop_growth(generator)
+                child_worst = (child_worst[0] + (growth == "n"), child_worst[1] + (growth == "log"))
+            growth = "1"
+        else:
+            growth = "1"
+            child_depth, child_worst = loop_profile(child, depth)
+        child_worst = (child_worst[0] + (growth == "n"), child_worst[1] + (growth == "log"))
+        max_depth = max(max_depth, child_depth)
+        worst = max(worst, child_worst)
+    return max_depth, worst
+
+def format_big_o(n_power, log_power):
+    if n_power == 0 and log_power == 0:
+        return "O(1)"
+    parts = []
+    if n_power:
+        parts.append("n" if n_power == 1 else f"n^{n_power}")
+    if log_power:
+        parts.append("log n" if log_power == 1 else f"log^{log_power} n")
+    return "O(" + " ".join(parts) + ")"
+
+def count_self_calls(func_node):
+    return sum(1 for child in ast.walk(func_node)
+               if isinstance(child, ast.Call) and isinstance(child.func, ast.Name) and child.func.id == func_node.name)
+
+def function_metrics(func_node):
+    max_depth, (n_power, log_power) = loop_profile(func_node)
+    self_calls = count_self_calls(func_node)
+    if self_calls >= 2:
+        big_o = "O(2^n)"  # 多分支递归（如朴素斐波那契），按指数级估计
+    else:
+        if self_calls == 1:
+            n_power += 1  # 线性递归相当于多一层循环
+        big_o = format_big_o(n_power, log_power)
+    return {
+        "name": func_node.name,
+        "lineno": func_node.lineno,
+        "lines": func_node.end_lineno - func_node.lineno + 1,
+        "cyclomatic_complexity": cyclomatic_complexity(func_node),
+        "max_loop_depth": max_depth,
+        "recursive": self_calls > 0,
+        "estimated_big_o": big_o
+    }
+
+def compute_static_metrics(code, tree=None, parse_error=None):
+    """
+    AST静态指标：圈复杂度、循环嵌套深度、递归、简单循环的复杂度估计、函数规模
+    毫秒级完成，在调用模型前直接返回；big-O 只是按循环结构的粗略估计
+    tree/parse_error 为已有的解析结果时不再重复解析
+    """
+    start = time.perf_counter()
+    try:
+        if parse_error is not None:
+            raise parse_error
+        if tree is None:
+            tree = ast.parse(textwrap.dedent(code))  # 标记之间的代码可能带缩进
+    except SyntaxError as e:
+        metrics = {"parsed": False, "error": f"语法错误（第{e.lineno}行）: {e.msg}"}
+        metrics["summary"] = format_static_metrics(metrics)
+        return metrics
+    
+    functions = [function_metrics(node) for node in ast.walk(tree)
+                 if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))]
+    module_depth, (n_power, log_power) = loop_profile(tree)
+    metrics = {
+        "parsed": True,
+        "lines": len([line for line in code.splitlines() if line.strip()]),
+        "cyclomatic_complexity": cyclomatic_complexity(tree),
+        "max_loop_depth": max([module_depth] + [f["max_loop_depth"] for f in functions]),
+        "module_big_o": format_big_o(n_power, log_power),
+        "recursive_functions": [f["name"] for f in functions if f["recursive"]],
+        "functions": functions,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 2)
+    }
+    metrics["summary"] = format_static_metrics(metrics)
+    return metrics
+
+def format_static_metrics(metrics):
+    """把静态指标整理成简短文本，既返回给前端，也放进提示词供模型引用"""
+    if not metrics.get("parsed"):
+        return f"静态分析失败：{metrics.get('error', '')}"
+    lines = [
+        f"- 非空行数: {metrics['lines']}，整体圈复杂度: {metrics['cyclomatic_complexity']}，"
+        f"最大循环嵌套: {metrics['max_loop_depth']}，模块级代码估计: {metrics['module_big_o']}"
+    ]
+    for f in metrics["functions"]:
+        lines.append(
+            f"- 函数 {f['name']}（第{f['lineno']}行，{f['lines']}行）: 圈复杂度 {f['cyclomatic_complexity']}，"
+            f"循环嵌套 {f['max_loop_depth']}，{'递归，' if f['recursive'] else ''}估计 {f['estimated_big_o']}"
+        )
+    return "📐 静态指标（AST计算）：\n" + "\n".join(lines)
+
+def with_static_metrics(prompt, metrics):
+    """把静态指标附加到提示词，模型直接引用，不必自己推算复杂度"""
+    if not metrics or not metrics.get("parsed"):
+        return prompt
+    return (f"{prompt}\n\n    以下静态指标由AST精确计算（big-O为按循环结构的估计），复杂度分析请以此为准并解释原因：\n"
+            f"{truncate_to_budget(metrics['summary'], PROMPT_METRICS_TOKEN_BUDGET)}")
+
+# ========== 提示词预算（代码压缩 + 大文件分块汇总） ==========
+PROMPT_CODE_TOKEN_BUDGET = 1500     # 单个提示词中代码部分的token上限
+PROMPT_REQUEST_TOKEN_LIMIT = 8000   # 一次分析请求（含分块和汇总）的提示词token总上限
+PROMPT_METRICS_TOKEN_BUDGET = 300   # 附加的静态指标摘要的token上限
+PROMPT_ERROR_TOKEN_BUDGET = 500     # 调试提示词中错误信息、堆栈各自的token上限
+PROMPT_TEMPLATE_TOKENS = 100        # 提示词模板本身约占的token数
+MAP_REDUCE_MAX_WORKERS = 4          # 分块并行分析的线程数
+
+analysis_executor = ThreadPoolExecutor(max_workers=MAP_REDUCE_MAX_WORKERS, thread_name_prefix="analysis")
+
+def minify_code(code):
+    """去掉注释、文档字符串和空行（仅用于缩短提示词，不用于执行）"""
+    docstring_lines = set()
+    try:
+        tree = ast.parse(code)
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and node.body:
+                first = node.body[0]
+                if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+                    docstring_lines.update(range(first.lineno, first.end_lineno + 1))
+    except SyntaxError:
+        pass
+    
+    comment_cols = {}  # 行号 -> 注释起始列
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(code).readline):
+            if tok.type == tokenize.COMMENT:
+                comment_cols[tok.start[0]] = tok.start[1]
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        pass
     
-    return result_queue.get()
+    lines = []
+    for lineno, line in enumerate(code.splitlines(), start=1):
+        if lineno in docstring_lines:
+            continue
+        if lineno in comment_cols:
+            line = line[:comment_cols[lineno]]
+        if line.strip():
+            lines.append(line.rstrip())
+    return "\n".join(lines)
 
-def extract_code_blocks(text):
-    """从文本中提取代码块（如果需要支持Markdown格式）"""
-    code_pattern = r'```(?:\w+)?\s*([\s\S]*?)```'
-    matches = re.findall(code_pattern, text, re.MULTILINE)
+def fit_code_to_budget(code, budget=PROMPT_CODE_TOKEN_BUDGET):
+    """代码超出预算时先压缩，压缩后仍超出则截断（需要完整分析大代码时先用 needs_map_reduce 判断并分块）"""
+    if estimate_tokens(code) <= budget:
+        return code
+    return truncate_to_budget(minify_code(code), budget)
+
+def truncate_to_budget(text, budget=PROMPT_CODE_TOKEN_BUDGET):
+    """按行截断到预算内（用于diff等不能压缩的内容）"""
+    if estimate_tokens(text) <= budget:
+        return text
+    kept, used = [], 0
+    for line in text.splitlines():
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            # 超长的行按字符截取剩余预算（每个字符至多1个token）
+            if budget - used > 20:
+                kept.append(line[:budget - used])
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept) + "\n...（内容过长，已截断）"
+
+def needs_map_reduce(code):
+    return (estimate_tokens(code) > PROMPT_CODE_TOKEN_BUDGET
+            and estimate_tokens(minify_code(code)) > PROMPT_CODE_TOKEN_BUDGET)
+
+def split_code_into_chunks(code, budget=PROMPT_CODE_TOKEN_BUDGET):
+    """按顶层函数/类切分并合并成不超过预算的块；单个超大单元按行截断"""
+    units = get_code_artifact(code).units
+    sources = [minify_code(unit["source"]) for unit in units] if units else [minify_code(code)]
     
-    if matches:
-        return matches
-    else:
-        # 如果没有Markdown代码块，返回原始文本
-        return [text]
+    chunks = []
+    current, current_tokens = [], 0
+    for source in sources:
+        cost = estimate_tokens(source)
+        if cost > budget:
+            # 单元本身超出预算：按行切开
+            lines, part, part_tokens = source.splitlines(), [], 0
+            for line in lines:
+                line_cost = estimate_tokens(line)
+                if part and part_tokens + line_cost > budget:
+                    chunks.append("\n".join(part))
+                    part, part_tokens = [], 0
+                part.append(line)
+                part_tokens += line_cost
+            if part:
+                chunks.append("\n".join(part))
+            continue
+        if current and current_tokens + cost > budget:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(source)
+        current_tokens += cost
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def map_reduce_analysis(code, priority=PRIORITY_MANUAL, user_id="anonymous", static_metrics=None, model=None):
+    """
+    大代码分析：分块并行分析（map），再把各块摘要汇总成完整分析（reduce）
+    所有提示词合计不超过 PROMPT_REQUEST_TOKEN_LIMIT
+    返回: (是否成功, 分析内容)
+    """
+    cache_key = analysis_cache.make_key("explain", code, model)
+    cached = analysis_cache.get(cache_key)
+    if cached is not None:
+        return True, cached
+    
+    chunks = split_code_into_chunks(code)
+    # 为汇总步骤预留：摘要 + 静态指标 + 模板
+    remaining = PROMPT_REQUEST_TOKEN_LIMIT - PROMPT_CODE_TOKEN_BUDGET - PROMPT_METRICS_TOKEN_BUDGET - PROMPT_TEMPLATE_TOKENS
+    selected = []
+    for chunk in chunks:
+        cost = estimate_tokens(chunk) + PROMPT_TEMPLATE_TOKENS
+        if cost > remaining:
+            break
+        selected.append(chunk)
+        remaining -= cost
+    omitted = len(chunks) - len(selected)
+    
+    def analyze_chunk(index, chunk):
+        prompt = CODE_ANALYSIS_PROMPTS["explain_chunk"].format(index=index, total=len(selected), code=chunk)
+        return request_model_analysis(prompt, "explain_chunk", chunk, priority, user_id, model)
+    
+    futures = [analysis_executor.submit(analyze_chunk, i, chunk) for i, chunk in enumerate(selected, start=1)]
+    results = [future.result() for future in futures]
+    failed = [result for success, result in results if not success]
+    if failed:
+        return False, failed[0]
+    
+    # 每块摘要按token截断，合计不超过汇总预算（每块另有约10个token的标题）
+    per_summary_tokens = max(20, PROMPT_CODE_TOKEN_BUDGET // max(1, len(results)) - 10)
+    summaries = "\n\n".join(f"第{i}部分：\n{truncate_to_budget(result, per_summary_tokens)}"
+                             for i, (_, result) in enumerate(results, start=1))
+    if omitted:
+        summaries += f"\n\n（另有{omitted}部分代码超出分析预算，未包含）"
+    prompt = CODE_ANALYSIS_PROMPTS["explain_reduce"].format(summaries=summaries)
+    prompt = with_static_metrics(prompt, static_metrics or get_code_artifact(code).static_metrics)
+    success, result = request_model_analysis(prompt, "explain_reduce", None, priority, user_id, model)
+    if success:
+        analysis_cache.put(cache_key, result)
+    return success, result
 
-def analyze_code(code, analysis_type="explain", context=None):
-    """调用大模型分析代码"""
+def build_analysis_prompt(code, analysis_type="explain", context=None):
+    """
+    根据分析类型构建提示词
+    返回: (分析类型, 提示词, 缓存用的代码内容；None表示不缓存)
+    """
     if analysis_type not in CODE_ANALYSIS_PROMPTS:
         analysis_type = "explain"
     
     context = context or {}
+    cache_code = code
+    prompt_code = fit_code_to_budget(code)  # 超出预算时压缩（仍超出则截断）后再放进提示词
+    if analysis_type == "debug":
+        prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(
+            code=prompt_code,
+            error=truncate_to_budget(context.get('error', ''), PROMPT_ERROR_TOKEN_BUDGET),
+            stack_trace=truncate_to_budget(context.get('stack_trace', ''), PROMPT_ERROR_TOKEN_BUDGET)
+        )
+        cache_code = "\0".join([code, context.get('error', ''), context.get('stack_trace', '')])
+    elif analysis_type == "comparison":
+        code_a = context.get('code_a', code)
+        code_b = context.get('code_b', '')
+        prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(
+            code_a=fit_code_to_budget(code_a, PROMPT_CODE_TOKEN_BUDGET // 2),
+            code_b=fit_code_to_budget(code_b, PROMPT_CODE_TOKEN_BUDGET // 2)
+        )
+        cache_code = "\0".join([code_a, code_b])
+    elif analysis_type == "runtime_analysis":
+        context_str = json.dumps(context, ensure_ascii=False, indent=2) if isinstance(context, dict) else str(context)
+        prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(context=truncate_to_budget(context_str))
+        cache_code = None  # 运行时上下文每次不同，不缓存
+    else:
+        prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(code=prompt_code)
+        if analysis_type == "explain":
+            prompt = with_static_metrics(prompt, context.get("static_metrics") or get_code_artifact(code).static_metrics)
+    return analysis_type, prompt, cache_code
+
+def analyze_code(code, analysis_type="explain", context=None, priority=PRIORITY_MANUAL, user_id="anonymous", model=None):
+    """调用大模型分析代码（队列已满时抛出 SchedulerFullError，由接口返回429）"""
+    try:
+        success, result = _analyze_code(code, analysis_type, context, priority, user_id, model)
+        return result
+    except SchedulerFullError:
+        raise
+    except Exception as e:
+        return f"分析代码时出错: {str(e)}"
+
+def _analyze_code(code, analysis_type, context, priority, user_id, model):
+    """返回: (是否成功, 分析内容或错误信息)"""
+    if analysis_type == "explain" and needs_map_reduce(code):
+        return map_reduce_analysis(code, priority, user_id, (context or {}).get("static_metrics"), model)
+    analysis_type, prompt, cache_code = build_analysis_prompt(code, analysis_type, context)
+    return request_model_analysis(prompt, analysis_type, cache_code, priority, user_id, model)
+
+# 多个标记区域并行分析（与分块分析用不同的线程池，避免区域任务占满线程后等待分块任务）
+region_executor = ThreadPoolExecutor(max_workers=MAP_REDUCE_MAX_WORKERS, thread_name_prefix="region")
+
+def analyze_regions(regions, analysis_type="explain", priority=PRIORITY_MANUAL, user_id="anonymous", model=None):
+    """
+    每个标记区域单独分析（并行），结果按区域顺序合并
+    返回: (是否全部成功, 合并后的分析内容)
+    """
+    futures = [
+        region_executor.submit(_analyze_code, region["code"], analysis_type, None, priority, user_id, model)
+        for region in regions
+    ]
+    sections = []
+    all_success = True
+    for index, (region, future) in enumerate(zip(regions, futures), start=1):
+        try:
+            success, result = future.result()
+        except SchedulerFullError:
+            raise
+        except Exception as e:
+            success, result = False, f"分析代码时出错: {str(e)}"
+        all_success = all_success and success
+        sections.append(f"### 区域{index}（第{region['start_line']}-{region['end_line']}行）\n{result}")
+    return all_success, "\n\n".join(sections)
+
+def wants_stream():
+    """分析类接口的流式开关：请求体 stream=true 或查询参数 ?stream=1"""
+    data = request.get_json(silent=True) or {}
+    return bool(data.get("stream")) or request.args.get("stream") in ("1", "true")
+
+def ndjson_frame(data):
+    return json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n'
+
+def stream_analysis_response(prompt, analysis_type, cache_code=None, priority=PRIORITY_MANUAL, user_id="anonymous", extra=None, model=None):
+    """
+    流式分析接口的响应：中转Ollama的NDJSON（与 /api/chat 格式一致），
+    最后追加一行 {"done": true, "analysis_complete": true, ...} 汇总；完整结果写入缓存
+    排队和连接在返回响应前完成，失败时直接抛出异常由接口处理
+    """
+    model = model or OLLAMA_MODEL_NAME
+    cache_key = analysis_cache.make_key(analysis_type, cache_code, model) if cache_code is not None else None
+    summary = dict(extra or {})
+    summary.update({"done": True, "analysis_complete": True, "analysis_type": analysis_type})
+    # 静态指标不依赖模型，作为第一行立即返回
+    leading = {"static_metrics": summary["static_metrics"], "done": False} if summary.get("static_metrics") else None
+    
+    cached = analysis_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        def generate_cached():
+            if leading:
+                yield ndjson_frame(leading)
+            yield ndjson_frame({"message": {"role": "assistant", "content": cached}, "done": False})
+            yield ndjson_frame(dict(summary, cached=True, analysis=cached))
+        return Response(generate_cached(), mimetype="application/x-ndjson")
     
+    granted_at = model_scheduler.acquire(priority, user_id)
+    backend = ollama_pool.pick(model)
     try:
-        if analysis_type == "debug":
-            prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(
-                code=code,
-                error=context.get('error', ''),
-                stack_trace=context.get('stack_trace', '')
-            )
-        elif analysis_type == "comparison":
-            code_a = context.get('code_a', code)
-            code_b = context.get('code_b', '')
-            prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(
-                code_a=code_a,
-                code_b=code_b
-            )
-        elif analysis_type == "runtime_analysis":
-            context_str = json.dumps(context, ensure_ascii=False, indent=2) if isinstance(context, dict) else str(context)
-            prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(context=context_str)
-        else:
-            prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(code=code)
-        
-        response = requests.post(
-            OLLAMA_CHAT_URL,
-            json={
-                "model": OLLAMA_MODEL_NAME,
-                "messages": [{"role": "user", "content": prompt}],
-                "stream": False
-            },
-            timeout=30
-        )
+        response = backend.stream_chat({
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": True,
+            "keep_alive": OLLAMA_KEEP_ALIVE
+        }, timeout=OLLAMA_CHAT_TIMEOUT)
+    except Exception as e:
+        if isinstance(e, requests.exceptions.ConnectionError):
+            ollama_pool.mark_failed(backend, e)
+        model_scheduler.release(granted_at)
+        raise
+    
+    released = threading.Event()
+    
+    def release():
+        # 生成器结束和响应关闭都会调用，只释放一次
+        if not released.is_set():
+            released.set()
+            response.close()
+            model_scheduler.release(granted_at)
+    
+    def generate():
+        raw_parts = []
+        try:
+            if leading:
+                yield ndjson_frame(leading)
+            if response.status_code != 200:
+                yield ndjson_frame({"error": f"模型调用失败: {response.status_code}", "done": True})
+                return
+            for chunk in response.iter_content(chunk_size=None):
+                if chunk:
+                    raw_parts.append(chunk)
+                    yield chunk
+        finally:
+            release()
         
-        if response.status_code == 200:
-            result = response.json()
-            return result.get("message", {}).get("content", "分析失败")
+        content, _ = parse_ndjson_reply(raw_parts)
+        if cache_key and content:
+            analysis_cache.put(cache_key, content)
+        yield ndjson_frame(dict(summary, cached=False, analysis=content))
+    
+    result = Response(generate(), mimetype="application/x-ndjson")
+    # 客户端在第一帧之前断开时生成器从未开始，finally 不会执行
+    result.call_on_close(release)
+    return result
+
+# ========== 增量分析（按顶层函数/类比较AST） ==========
+# key=(user_id, filename), value={单元名: AST哈希}，记录上次保存时各单元的结构
+CODE_UNIT_VERSIONS = {}
+CODE_UNIT_KIND_NAMES = {"function": "函数", "class": "类", "module": "模块级代码"}
+
+def split_code_units(code, tree=None):
+    """
+    把代码拆成顶层函数/类，其余语句合并为一个模块级单元
+    tree 为已解析的AST（与 CodeArtifact.tree 一样按去掉公共缩进后的代码解析）时不再重复解析
+    返回: [{"name", "kind", "source", "ast_dump", "hash", "lineno"}]；无法解析时返回 None
+    """
+    code = textwrap.dedent(code)  # 与AST的列偏移保持一致
+    if tree is None:
+        try:
+            tree = ast.parse(code)
+        except SyntaxError:
+            return None
+    
+    units = []
+    module_nodes = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            kind = "class" if isinstance(node, ast.ClassDef) else "function"
+            # 装饰器也属于该单元
+            start = node.decorator_list[0] if node.decorator_list else node
+            lines = code.splitlines()[start.lineno - 1:node.end_lineno]
+            units.append({
+                "name": node.name,
+                "kind": kind,
+                "source": "\n".join(lines),
+                "ast_dump": ast.dump(node),
+                "lineno": node.lineno
+            })
         else:
-            return f"模型调用失败: {response.status_code}"
-    except Exception as e:
-        return f"分析代码时出错: {str(e)}"
+            module_nodes.append(node)
+    
+    if module_nodes:
+        units.append({
+            "name": "<module>",
+            "kind": "module",
+            "source": "\n".join(ast.get_source_segment(code, node) or "" for node in module_nodes),
+            "ast_dump": "\n".join(ast.dump(node) for node in module_nodes),
+            "lineno": module_nodes[0].lineno
+        })
+    for unit in units:
+        # AST不含注释、空白和行号，只改格式或注释不会被视为修改
+        unit["hash"] = hashlib.sha256(unit["ast_dump"].encode('utf-8')).hexdigest()
+    return units
+
+def analyze_code_incrementally(code, user_id, filename, priority=PRIORITY_AUTO_SAVE, model=None, artifact=None):
+    """
+    只对与上次保存相比发生变化的函数/类调用模型（并行），未变化的单元沿用缓存的分析结果；
+    未变化但没有缓存结果的单元（例如上次是整体分析）不重新分析
+    返回: (是否成功, 合并后的分析, 增量信息)；代码无法拆分（语法错误或只有一个单元）、
+    或该文件第一次保存（没有上一版本可比较）时返回 None，由调用方整体分析一次
+    """
+    units = (artifact or get_code_artifact(code)).units  # 复用提交时已解析的AST
+    if not units or len(units) < 2:
+        return None
+    
+    current = {unit["name"]: unit["hash"] for unit in units}
+    previous = CODE_UNIT_VERSIONS.get((user_id, filename))
+    if previous is None:
+        # 第一次保存：记录各单元结构，本次只做一次整体分析，不逐个单元调用模型
+        CODE_UNIT_VERSIONS[(user_id, filename)] = current
+        return None
+    changed = {u["name"] for u in units if previous.get(u["name"]) != u["hash"]}
+    cached = {u["name"] for u in units
+              if analysis_cache.contains(analysis_cache.make_key("explain_unit", u["ast_dump"], model))}
+    to_analyze = [u for u in units if u["name"] in changed and u["name"] not in cached]
+    report = {
+        "changed": [u["name"] for u in units if u["name"] in changed],
+        "unchanged": [u["name"] for u in units if u["name"] not in changed],
+        "removed": [name for name in previous if name not in current],
+        "reused": [u["name"] for u in units if u["name"] in cached],
+        "skipped": [u["name"] for u in units if u["name"] not in changed and u["name"] not in cached],
+        "model_calls": len(to_analyze)
+    }
+    
+    def analyze_unit(unit):
+        prompt = CODE_ANALYSIS_PROMPTS["explain_unit"].format(
+            kind=CODE_UNIT_KIND_NAMES[unit["kind"]], name=unit["name"], code=fit_code_to_budget(unit["source"]))
+        prompt = with_static_metrics(prompt, get_code_artifact(unit["source"]).static_metrics)
+        # 以AST作为缓存内容：之后未修改的单元直接命中缓存，不调用模型
+        return request_model_analysis(prompt, "explain_unit", unit["ast_dump"], priority, user_id, model)
+    
+    futures = {unit["name"]: analysis_executor.submit(analyze_unit, unit)
+               for unit in units if unit["name"] in changed or unit["name"] in cached}
+    
+    sections = []
+    all_success = True
+    for unit in units:
+        kind_name = CODE_UNIT_KIND_NAMES[unit["kind"]]
+        title = kind_name if unit["kind"] == "module" else f"{kind_name} {unit['name']}"
+        future = futures.get(unit["name"])
+        if future is None:
+            continue
+        success, result = future.result()
+        all_success = all_success and success
+        if unit["name"] in cached:
+            state = "沿用已有分析"
+        else:
+            state = "已修改，重新分析"
+        sections.append(f"### {title}（第{unit['lineno']}行，{state}）\n{result}")
+    
+    if all_success:
+        CODE_UNIT_VERSIONS[(user_id, filename)] = current
+    if report["skipped"]:
+        sections.append("### 未修改（本次未重新分析）\n" + "、".join(report["skipped"]))
+    if report["removed"]:
+        sections.append("### 已删除\n" + "、".join(report["removed"]))
+    return all_success, "\n\n".join(sections), report
+
+# ========== 代码版本历史（按文件保存增量） ==========
+CODE_VERSION_HISTORY_MAX = 20   # 每个文件保留的版本数
+CODE_DIFF_CONTEXT_LINES = 3     # diff 中保留的上下文行数
+
+def make_reverse_delta(new_lines, old_lines):
+    """记录从新版本还原旧版本所需的修改：[(起始行, 结束行, 替换内容)]"""
+    matcher = difflib.SequenceMatcher(None, new_lines, old_lines, autojunk=False)
+    return [(i1, i2, old_lines[j1:j2]) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+def apply_reverse_delta(new_lines, delta):
+    old_lines = list(new_lines)
+    for i1, i2, replacement in reversed(delta):  # 从后往前改，前面的行号不受影响
+        old_lines[i1:i2] = replacement
+    return old_lines
+
+class CodeVersionHistory:
+    """
+    每个 (user_id, filename) 只保存最新版本全文，
+    更早的版本保存为相对后一版本的反向增量
+    """
+    def __init__(self, max_versions=CODE_VERSION_HISTORY_MAX):
+        self.max_versions = max_versions
+        self.files = {}  # key -> {"latest": [行], "deltas": [最近的在最后], "version": 版本号}
+        self.lock = threading.Lock()
+    
+    def record(self, user_id, filename, code):
+        """
+        保存新版本，返回上一个不同版本的全文；没有历史时返回 None
+        （内容未变时不新增版本，例如任务重试时重复提交）
+        """
+        key = (user_id, filename)
+        lines = code.splitlines()
+        with self.lock:
+            entry = self.files.get(key)
+            if entry is None:
+                self.files[key] = {"latest": lines, "deltas": [], "version": 1}
+                return None
+            previous = entry["latest"]
+            if previous == lines:
+                if not entry["deltas"]:
+                    return None
+                return "\n".join(apply_reverse_delta(lines, entry["deltas"][-1]))
+            entry["deltas"].append(make_reverse_delta(lines, previous))
+            del entry["deltas"][:-(self.max_versions - 1)]
+            entry["latest"] = lines
+            entry["version"] += 1
+            return "\n".join(previous)
+    
+    def get_version(self, user_id, filename, steps_back=0):
+        """取回 steps_back 个版本之前的全文，超出保留范围返回 None"""
+        with self.lock:
+            entry = self.files.get((user_id, filename))
+            if entry is None or steps_back > len(entry["deltas"]):
+                return None
+            lines = entry["latest"]
+            for delta in reversed(entry["deltas"][len(entry["deltas"]) - steps_back:]):
+                lines = apply_reverse_delta(lines, delta)
+            return "\n".join(lines)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                "files": len(self.files),
+                "versions": sum(len(entry["deltas"]) + 1 for entry in self.files.values())
+            }
+
+code_version_history = CodeVersionHistory()
+
+def make_code_diff(old_code, new_code, filename="code"):
+    return "\n".join(difflib.unified_diff(
+        old_code.splitlines(), new_code.splitlines(),
+        fromfile=f"{filename} (上一版本)", tofile=f"{filename} (当前版本)",
+        n=CODE_DIFF_CONTEXT_LINES, lineterm=""
+    ))
 
 def analyze_runtime_point(context):
     """分析运行时的关键点"""
@@ -692,7 +2577,10 @@ def analyze_runtime_point(context):
         analysis = analyze_code(
             "",
             "runtime_analysis",
-            context=context
+            context=context,
+            priority=PRIORITY_RUNTIME,
+            user_id=context.get("user_id", "anonymous"),
+            model=model_for_route("runtime")
         )
         
         # 保存分析结果
@@ -705,10 +2593,10 @@ def analyze_runtime_point(context):
             "status": "completed"
         }
         
-        print(f"✅ 运行时分析完成: {analysis_id}")
+        log_event("INFO", "runtime", f"✅ 运行时分析完成: {analysis_id}")
         
     except Exception as e:
-        print(f"❌ 运行时分析失败: {str(e)}")
+        log_event("ERROR", "runtime", f"❌ 运行时分析失败: {str(e)}")
 
 def monitor_code_execution():
     """监控代码执行的线程函数"""
@@ -727,6 +2615,7 @@ def monitor_code_execution():
                 "timestamp": datetime.now().isoformat(),
                 "user_id": user_id
             }
+            status_notifier.notify(execution_id)
             
             # 清理旧结果（保留最近10个）
             if len(execution_results) > 10:
@@ -737,7 +2626,7 @@ def monitor_code_execution():
         except queue.Empty:
             continue
         except Exception as e:
-            print(f"代码执行监控错误: {str(e)}")
+            log_event("ERROR", "execution", f"代码执行监控错误: {str(e)}")
 
 # ========== VSCode集成配置 ==========
 VSCODE_PROJECT_PATHS = []  # 监控的VSCode项目路径
@@ -772,9 +2661,9 @@ class VSCodeFileHandler(FileSystemEventHandler):
                     full_code = f.read()
                 
                 # 提取标记区间内的代码
-                target_code = extract_code_between_markers(full_code)
-                if not target_code:
-                    target_code = full_code
+                artifact = get_code_artifact(full_code)
+                target = artifact.target or artifact
+                target_code = target.text
                 
                 # 保存最近修改的代码
                 VSCODE_CODE_SNIPPETS[self.user_id] = {
@@ -783,34 +2672,30 @@ class VSCodeFileHandler(FileSystemEventHandler):
                     'time': datetime.now()
                 }
                 
-                print(f"📝 检测到VSCode代码修改: {file_path}")
+                log_event("INFO", "watcher", f"📝 检测到VSCode代码修改: {file_path}")
                 
                 # 如果启用自动上传，则自动分析
                 if self.auto_upload and len(target_code.strip()) > 10:
-                    analysis_id = f"auto_{int(time.time())}_{hashlib.md5(target_code.encode()).hexdigest()[:8]}"
+                    analysis_id = f"auto_{int(time.time())}_{target.short_id}"
                     
-                    threading.Thread(
-                        target=process_auto_upload_analysis,
-                        args=(analysis_id, target_code, self.user_id, os.path.basename(file_path), "save"),
-                        daemon=True
-                    ).start()
+                    analysis_jobs.submit(analysis_id, target_code, self.user_id, os.path.basename(file_path), "save")
                     
-                    print(f"🔄 自动分析已触发: {analysis_id}")
+                    log_event("INFO", "watcher", f"🔄 自动分析已触发: {analysis_id}")
                     
             except Exception as e:
-                print(f"❌ 读取代码文件失败: {str(e)}")
+                log_event("ERROR", "watcher", f"❌ 读取代码文件失败: {str(e)}")
 
 def start_vscode_monitor(user_id, project_path, auto_upload=False):
     """启动VSCode项目监控"""
     if not os.path.exists(project_path):
-        print(f"❌ 项目路径不存在: {project_path}")
+        log_event("ERROR", "monitor", f"❌ 项目路径不存在: {project_path}")
         return None
     
     try:
         # 检查是否已经在监控中
         for item in VSCODE_PROJECT_PATHS:
             if item['user_id'] == user_id and item['path'] == project_path:
-                print(f"⚠️ 已在监控中: {project_path}")
+                log_event("WARNING", "monitor", f"⚠️ 已在监控中: {project_path}")
                 return item['observer']
         
         event_handler = VSCodeFileHandler(user_id, project_path, auto_upload)
@@ -826,11 +2711,10 @@ def start_vscode_monitor(user_id, project_path, auto_upload=False):
             'start_time': datetime.now()
         })
         
-        print(f"✅ 开始监控VSCode项目: {project_path} (自动上传: {auto_upload})")
+        log_event("INFO", "monitor", f"✅ 开始监控VSCode项目: {project_path} (自动上传: {auto_upload})")
         return observer
     except Exception as e:
-        print(f"❌ 启动监控失败: {str(e)}")
-        traceback.print_exc()
+        log_event("ERROR", "monitor", f"❌ 启动监控失败: {str(e)}", traceback=traceback.format_exc())
         return None
 
 def stop_vscode_monitor(user_id, project_path=None):
@@ -846,13 +2730,13 @@ def stop_vscode_monitor(user_id, project_path=None):
             item['observer'].stop()
             item['observer'].join()
             VSCODE_PROJECT_PATHS.remove(item)
-            print(f"✅ 停止监控VSCode项目: {item['path']}")
+            log_event("INFO", "monitor", f"✅ 停止监控VSCode项目: {item['path']}")
         except Exception as e:
-            print(f"❌ 停止监控失败: {str(e)}")
+            log_event("ERROR", "monitor", f"❌ 停止监控失败: {str(e)}")
             return False
     
     if not items_to_remove:
-        print(f"⚠️ 未找到用户 {user_id} 的监控项目")
+        log_event("WARNING", "monitor", f"⚠️ 未找到用户 {user_id} 的监控项目")
         return False
     
     return True
@@ -861,7 +2745,8 @@ def process_auto_upload_analysis(analysis_id, code, user_id, filename, trigger_t
     """处理自动上传的分析"""
     try:
         # 先检测标签
-        detection_result = smart_detect_markers(code)
+        artifact = get_code_artifact(code)
+        detection_result = artifact.detection
         
         if detection_result["found_markers"] and detection_result["is_valid_snippet"]:
             # 有标记且有代码 -> 分析
@@ -874,24 +2759,31 @@ def process_auto_upload_analysis(analysis_id, code, user_id, filename, trigger_t
                 "trigger_type": trigger_type,
                 "timestamp": datetime.now().isoformat(),
                 "status": "analyzing",
-                "detection_result": detection_result
+                "detection_result": detection_result,
+                # 静态指标立即可查，不等模型结果
+                "static_metrics": artifact.target.static_metrics
             }
+            status_notifier.notify(analysis_id)
+            
+            # 记录版本历史，取得上一版本用于对比
+            previous_code = code_version_history.record(user_id, filename, extracted_code)
             
             # 根据触发类型选择分析方式
             analysis_type = "explain"
             if trigger_type == "run":
                 analysis_type = "runtime_analysis"
-            elif trigger_type == "test":
+            elif trigger_type == "test" and previous_code is not None:
                 analysis_type = "comparison"
             elif trigger_type == "debug":
                 analysis_type = "debug"
             else:
                 analysis_type = "explain"
             
-            # 调用大模型分析
+            # 调用大模型分析（未修改的代码直接命中缓存）
+            cache_code = extracted_code
             if analysis_type == "runtime_analysis":
                 context = {
-                    "code": extracted_code,
+                    "code": fit_code_to_budget(extracted_code),
                     "user_id": user_id,
                     "filename": filename,
                     "trigger_type": trigger_type,
@@ -900,26 +2792,41 @@ def process_auto_upload_analysis(analysis_id, code, user_id, filename, trigger_t
                 }
                 prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(context=json.dumps(context, ensure_ascii=False))
             elif analysis_type == "comparison":
-                prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(code_a=extracted_code, code_b=extracted_code)
+                # 只发送与上一版本的diff，而不是两份全文
+                diff = make_code_diff(previous_code, extracted_code, filename)
+                prompt = CODE_ANALYSIS_PROMPTS["comparison_diff"].format(
+                    filename=filename, diff=truncate_to_budget(diff))
+                cache_code = diff
             elif analysis_type == "debug":
-                prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(code=extracted_code, error="", stack_trace="")
+                prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(code=fit_code_to_budget(extracted_code), error="", stack_trace="")
+                cache_code = "\0".join([extracted_code, "", ""])
             else:
-                prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(code=extracted_code)
+                prompt = CODE_ANALYSIS_PROMPTS[analysis_type].format(code=fit_code_to_budget(extracted_code))
+                prompt = with_static_metrics(prompt, VSCODE_AUTO_ANALYSIS_CACHE[analysis_id]["static_metrics"])
             
-            response = requests.post(
-                OLLAMA_CHAT_URL,
-                json={
-                    "model": OLLAMA_MODEL_NAME,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "stream": False
-                },
-                timeout=30
-            )
+            # 保存触发的自动分析优先级低于手动触发，并按触发类型选择模型档位
+            priority = PRIORITY_AUTO_SAVE if trigger_type == "save" else PRIORITY_MANUAL
+            model = model_for_route(f"auto_{trigger_type}")
+            VSCODE_AUTO_ANALYSIS_CACHE[analysis_id]["model"] = model
+            incremental = None
+            if analysis_type == "explain":
+                # 多个函数/类时只分析修改过的部分
+                incremental = analyze_code_incrementally(extracted_code, user_id, filename, priority, model, artifact.target)
+            if incremental is not None:
+                success, analysis_result, incremental_report = incremental
+                VSCODE_AUTO_ANALYSIS_CACHE[analysis_id]["incremental"] = incremental_report
+            elif analysis_type == "comparison" and not cache_code:
+                success, analysis_result = True, "与上一版本相比没有修改，无需比较。"
+            elif analysis_type == "explain" and len(detection_result["regions"]) > 1:
+                # 多个标记区域分别分析
+                success, analysis_result = analyze_regions(detection_result["regions"], analysis_type, priority, user_id, model)
+            elif analysis_type == "explain" and needs_map_reduce(extracted_code):
+                success, analysis_result = map_reduce_analysis(
+                    extracted_code, priority, user_id, VSCODE_AUTO_ANALYSIS_CACHE[analysis_id]["static_metrics"], model)
+            else:
+                success, analysis_result = request_model_analysis(prompt, analysis_type, cache_code, priority, user_id, model)
             
-            if response.status_code == 200:
-                result = response.json()
-                analysis_result = result.get("message", {}).get("content", "分析失败")
-                
+            if success:
                 # 保存结果
                 VSCODE_AUTO_ANALYSIS_CACHE[analysis_id].update({
                     "status": "completed",
@@ -928,12 +2835,12 @@ def process_auto_upload_analysis(analysis_id, code, user_id, filename, trigger_t
                     "analysis_type": analysis_type
                 })
                 
-                print(f"✅ 自动分析完成: {filename} (ID: {analysis_id})")
+                log_event("INFO", "auto_analyze", f"✅ 自动分析完成: {filename} (ID: {analysis_id})")
                 
             else:
                 VSCODE_AUTO_ANALYSIS_CACHE[analysis_id].update({
                     "status": "failed",
-                    "error": f"模型调用失败: {response.status_code}"
+                    "error": analysis_result
                 })
         else:
             # 没有标记或标记不完整 -> 记录但不分析
@@ -947,14 +2854,288 @@ def process_auto_upload_analysis(analysis_id, code, user_id, filename, trigger_t
                 "detection_result": detection_result,
                 "analysis": detection_result["message"]
             }
-            print(f"⏭️ 自动分析跳过（无标记）: {filename}")
+            log_event("INFO", "auto_analyze", f"⏭️ 自动分析跳过（无标记）: {filename}")
             
     except Exception as e:
         VSCODE_AUTO_ANALYSIS_CACHE[analysis_id].update({
             "status": "failed",
             "error": str(e)
         })
-        print(f"❌ 自动分析处理失败: {str(e)}")
+        log_event("ERROR", "auto_analyze", f"❌ 自动分析处理失败: {str(e)}")
+
+# ========== 状态长轮询（每个任务一个条件变量） ==========
+LONG_POLL_MAX_WAIT = 30  # ?wait= 的上限（秒）
+
+class StatusNotifier:
+    """
+    状态接口的长轮询：每个等待中的请求一个条件变量，登记在它关心的任务上，
+    状态变化时由写入方 notify 该任务；没有等待者的任务不占用任何条件变量
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}  # key -> {Condition}
+    
+    def notify(self, key):
+        with self.lock:
+            for condition in self.waiters.get(key, ()):
+                condition.notify_all()
+    
+    def wait(self, keys, predicate, timeout):
+        """
+        等待直到 predicate() 为真或超时，返回 predicate() 的最终结果
+        keys 可以是单个任务ID，也可以是多个（批量状态接口，任一任务变化即唤醒）
+        """
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        condition = threading.Condition(self.lock)
+        with self.lock:
+            for key in keys:
+                self.waiters.setdefault(key, set()).add(condition)
+            try:
+                return condition.wait_for(predicate, timeout)
+            finally:
+                for key in keys:
+                    self.waiters[key].discard(condition)
+                    if not self.waiters[key]:
+                        del self.waiters[key]
+    
+    def stats(self):
+        with self.lock:
+            return {"waiting_jobs": len(self.waiters),
+                    "waiters": len(set().union(*self.waiters.values())) if self.waiters else 0}
+
+status_notifier = StatusNotifier()
+
+def requested_wait():
+    """解析 ?wait=<秒>，限制在 0 ~ LONG_POLL_MAX_WAIT"""
+    try:
+        return max(0.0, min(float(request.args.get("wait", 0)), LONG_POLL_MAX_WAIT))
+    except ValueError:
+        return 0.0
+
+# ========== 持久化分析任务队列（SQLite WAL + 固定工作线程） ==========
+ANALYSIS_JOB_DB = os.path.join("cache", "analysis_jobs.db")
+ANALYSIS_JOB_WORKERS = 4          # 固定的工作线程数
+ANALYSIS_JOB_MAX_ATTEMPTS = 3     # 每个任务最多执行次数
+ANALYSIS_JOB_BACKOFF = 5          # 重试退避基数（秒），第n次重试等待 5 * 2^(n-1) 秒
+ANALYSIS_JOB_TIMEOUT = 180        # 单次执行超时（秒），超时按失败处理并重试
+ANALYSIS_JOB_RETENTION = 86400    # 已结束任务的保留时间（秒）
+ANALYSIS_JOB_FINAL_STATUSES = ("completed", "skipped", "failed")
+
+class AnalysisJobQueue:
+    """
+    自动分析任务队列：任务表持久化在SQLite（WAL模式），由固定数量的工作线程执行
+    VSCODE_AUTO_ANALYSIS_CACHE 是任务表的内存视图，排队、执行、重试和结束时都写回任务表；
+    重启后未完成的任务重新排队，已结束的记录恢复到内存中供状态接口查询
+    """
+    def __init__(self, db_path=ANALYSIS_JOB_DB, workers=ANALYSIS_JOB_WORKERS):
+        self.db_path = db_path
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.threads = []
+        self.running = {}  # job_id -> (attempt, 开始时间)
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_jobs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                filename TEXT,
+                trigger_type TEXT,
+                code TEXT,
+                status TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_run_at REAL,
+                created_at REAL,
+                updated_at REAL,
+                error TEXT,
+                record TEXT
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs (status, next_run_at)")
+        self.conn.commit()
+    
+    def _execute(self, sql, params=()):
+        """调用方需持有 self.lock"""
+        cursor = self.conn.execute(sql, params)
+        self.conn.commit()
+        return cursor
+    
+    def recover(self):
+        """重启恢复：执行到一半的任务重新排队，已有记录载入 VSCODE_AUTO_ANALYSIS_CACHE"""
+        with self.lock:
+            requeued = self._execute(
+                "UPDATE analysis_jobs SET status = 'queued', next_run_at = ? WHERE status = 'running'",
+                (time.time(),)
+            ).rowcount
+            rows = self.conn.execute("SELECT id, status, record FROM analysis_jobs").fetchall()
+        for job_id, status, record in rows:
+            record = json.loads(record) if record else {}
+            if status not in ANALYSIS_JOB_FINAL_STATUSES:
+                record["status"] = "queued"
+            VSCODE_AUTO_ANALYSIS_CACHE[job_id] = record
+        if rows:
+            log_event("INFO", "jobs", f"♻️ 恢复分析任务: {len(rows)} 条记录，{requeued} 个中断的任务重新排队")
+    
+    def submit(self, analysis_id, code, user_id, filename, trigger_type):
+        """提交任务；同一ID（相同代码同一秒内重复提交）只保留一个"""
+        now = time.time()
+        record = {
+            "user_id": user_id,
+            "filename": filename,
+            "trigger_type": trigger_type,
+            "timestamp": datetime.now().isoformat(),
+            "status": "queued"
+        }
+        with self.lock:
+            inserted = self._execute(
+                "INSERT OR IGNORE INTO analysis_jobs "
+                "(id, user_id, filename, trigger_type, code, status, attempts, next_run_at, created_at, updated_at, record) "
+                "VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)",
+                (analysis_id, user_id, filename, trigger_type, code, now, now, now, json.dumps(record, ensure_ascii=False))
+            ).rowcount
+            if inserted:
+                VSCODE_AUTO_ANALYSIS_CACHE[analysis_id] = record
+                self.wakeup.notify()
+        return bool(inserted)
+    
+    def save_record(self, analysis_id, status=None, error=None):
+        """把内存中的状态记录写回任务表，并唤醒等待该任务状态的长轮询请求"""
+        record = VSCODE_AUTO_ANALYSIS_CACHE.get(analysis_id)
+        if record is None:
+            return
+        with self.lock:
+            self._execute(
+                "UPDATE analysis_jobs SET record = ?, updated_at = ?, "
+                "status = COALESCE(?, status), error = COALESCE(?, error) WHERE id = ?",
+                (json.dumps(record, ensure_ascii=False, default=str), time.time(), status, error, analysis_id)
+            )
+        status_notifier.notify(analysis_id)
+    
+    def _claim(self):
+        """取出下一个可执行的任务（手动触发优先于保存触发）；调用方需持有 self.lock"""
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT id, user_id, filename, trigger_type, code, attempts FROM analysis_jobs "
+            "WHERE status = 'queued' AND next_run_at <= ? "
+            "ORDER BY (trigger_type = 'save'), created_at LIMIT 1",
+            (now,)
+        ).fetchone()
+        if row is None:
+            return None
+        attempt = row[5] + 1
+        self._execute(
+            "UPDATE analysis_jobs SET status = 'running', attempts = ?, updated_at = ? WHERE id = ?",
+            (attempt, now, row[0])
+        )
+        self.running[row[0]] = (attempt, now)
+        return row[:5] + (attempt,)
+    
+    def _next_wait(self):
+        """距离最近一个退避中任务可执行的时间，没有则等1秒；调用方需持有 self.lock"""
+        row = self.conn.execute("SELECT MIN(next_run_at) FROM analysis_jobs WHERE status = 'queued'").fetchone()
+        if row[0] is None:
+            return 1.0
+        return min(1.0, max(0.05, row[0] - time.time()))
+    
+    def _worker(self):
+        while True:
+            with self.lock:
+                job = self._claim()
+                while job is None:
+                    self.wakeup.wait(self._next_wait())
+                    job = self._claim()
+            job_id, user_id, filename, trigger_type, code, attempt = job
+            try:
+                process_auto_upload_analysis(job_id, code, user_id, filename, trigger_type)
+            except Exception as e:
+                VSCODE_AUTO_ANALYSIS_CACHE.setdefault(job_id, {}).update({"status": "failed", "error": str(e)})
+            self._finish(job_id, attempt)
+    
+    def _finish(self, job_id, attempt):
+        record = VSCODE_AUTO_ANALYSIS_CACHE.get(job_id, {})
+        status = record.get("status")
+        with self.lock:
+            current = self.running.get(job_id)
+            stale = current is None or current[0] != attempt
+            if not stale:
+                del self.running[job_id]
+        
+        if status in ("completed", "skipped"):
+            # 超时后才完成的结果同样有效，取消待重试的任务
+            self.save_record(job_id, status)
+            return
+        if stale:
+            return  # 本次执行已被判定超时并安排了重试，忽略迟到的失败
+        self._retry_or_fail(job_id, attempt, record.get("error", "分析失败"))
+    
+    def _retry_or_fail(self, job_id, attempt, error):
+        record = VSCODE_AUTO_ANALYSIS_CACHE.setdefault(job_id, {})
+        if attempt >= ANALYSIS_JOB_MAX_ATTEMPTS:
+            record.update({"status": "failed", "error": error, "attempts": attempt})
+            self.save_record(job_id, "failed", error)
+            log_event("ERROR", "jobs", f"❌ 分析任务失败（已重试{attempt - 1}次）: {job_id}: {error}")
+            return
+        delay = ANALYSIS_JOB_BACKOFF * 2 ** (attempt - 1)
+        record.update({"status": "queued", "error": error, "attempts": attempt, "retry_in": delay})
+        with self.lock:
+            self._execute(
+                "UPDATE analysis_jobs SET status = 'queued', next_run_at = ?, error = ?, updated_at = ?, record = ? WHERE id = ?",
+                (time.time() + delay, error, time.time(), json.dumps(record, ensure_ascii=False, default=str), job_id)
+            )
+            self.wakeup.notify()
+        status_notifier.notify(job_id)
+        log_event("WARNING", "jobs", f"🔁 分析任务 {delay}s 后重试（第{attempt}次失败）: {job_id}: {error}")
+    
+    def _watchdog(self):
+        """
+        执行超时的任务按失败处理并安排重试；线程无法被强制终止，
+        超时的工作线程结束后其结果若成功仍会被采用（见 _finish）
+        """
+        while True:
+            time.sleep(5)
+            now = time.time()
+            with self.lock:
+                expired = [(job_id, attempt) for job_id, (attempt, started) in self.running.items()
+                           if now - started > ANALYSIS_JOB_TIMEOUT]
+                for job_id, _ in expired:
+                    del self.running[job_id]
+            for job_id, attempt in expired:
+                self._retry_or_fail(job_id, attempt, f"分析超时（{ANALYSIS_JOB_TIMEOUT}秒）")
+    
+    def start(self):
+        if self.threads:
+            return
+        self.recover()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"analysis-job-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        watchdog_thread = threading.Thread(target=self._watchdog, name="analysis-job-watchdog", daemon=True)
+        watchdog_thread.start()
+        self.threads.append(watchdog_thread)
+    
+    def purge(self, older_than=ANALYSIS_JOB_RETENTION):
+        """删除已结束且超过保留时间的任务"""
+        with self.lock:
+            return self._execute(
+                "DELETE FROM analysis_jobs WHERE status IN ('completed', 'skipped', 'failed') AND updated_at < ?",
+                (time.time() - older_than,)
+            ).rowcount
+    
+    def stats(self):
+        with self.lock:
+            counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM analysis_jobs GROUP BY status").fetchall())
+            return {
+                "workers": self.workers,
+                "running": len(self.running),
+                "by_status": counts,
+                "db_path": self.db_path
+            }
+
+analysis_jobs = AnalysisJobQueue()
 
 # ========== 清理和监控线程 ==========
 def clean_old_analyses():
@@ -972,9 +3153,10 @@ def clean_old_analyses():
     
     for analysis_id in to_delete:
         del VSCODE_AUTO_ANALYSIS_CACHE[analysis_id]
+    analysis_jobs.purge()
     
     if to_delete:
-        print(f"🧹 清理了 {len(to_delete)} 条旧的自动分析记录")
+        log_event("INFO", "cleanup", f"🧹 清理了 {len(to_delete)} 条旧的自动分析记录")
 
 def schedule_cleanup():
     """定期清理任务（优化性能）"""
@@ -983,8 +3165,9 @@ def schedule_cleanup():
         try:
             clean_expired_history()
             clean_old_analyses()
+            rate_limiter.clean_idle()
         except Exception as e:
-            print(f"清理任务出错: {str(e)}")
+            log_event("ERROR", "cleanup", f"清理任务出错: {str(e)}")
 
 # ========== 启动监控线程 ==========
 if execution_monitor_thread is None:
@@ -995,6 +3178,202 @@ if execution_monitor_thread is None:
 cleanup_thread = threading.Thread(target=schedule_cleanup, daemon=True)
 cleanup_thread.start()
 
+# 启动Ollama后端健康检查线程
+ollama_health_thread = threading.Thread(target=ollama_health_loop, daemon=True)
+ollama_health_thread.start()
+
+# 启动自动分析任务的工作线程（并恢复重启前未完成的任务）
+analysis_jobs.start()
+
+# 启动模型预热/常驻线程
+model_residency_thread = threading.Thread(target=model_residency_loop, daemon=True)
+model_residency_thread.start()
+
+# ========== 异步流式服务（可选，依赖 aiohttp） ==========
+# 同步Flask模式下每条聊天流占用一个线程；异步模式用单个事件循环线程中转Ollama的NDJSON，
+# 线程数固定，可同时保持大量流。未安装 aiohttp 时自动退回同步模式。
+try:
+    import asyncio
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
+ASYNC_STREAM_ENABLED = True
+ASYNC_STREAM_PORT = 5001
+ASYNC_MAX_UPSTREAM = 1024  # 异步模式下同时保持的上游连接上限
+
+ASYNC_CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "*"
+}
+
+async_stream_state = {
+    "running": False,
+    "port": ASYNC_STREAM_PORT,
+    "open_streams": 0,
+    "total_streams": 0
+}
+
+async def acquire_model_slot_async(priority, user_id, timeout=MODEL_QUEUE_WAIT_TIMEOUT):
+    """异步版 model_scheduler.acquire：排队期间只挂起协程，不占用线程池线程"""
+    loop = asyncio.get_running_loop()
+    granted = loop.create_future()
+    
+    def resolve():
+        if not granted.done():
+            granted.set_result(None)
+    
+    ticket = model_scheduler.enqueue(priority, user_id, lambda: loop.call_soon_threadsafe(resolve))
+    if ticket is None:
+        return time.time()
+    try:
+        await asyncio.wait_for(granted, timeout)
+    except asyncio.TimeoutError:
+        outcome = model_scheduler.cancel(ticket, keep_if_granted=True)
+        if outcome is not True:
+            raise outcome
+    except asyncio.CancelledError:
+        model_scheduler.cancel(ticket)  # 客户端断开：撤下票据或归还已分配的槽位
+        raise
+    return time.time()
+
+async def async_chat_handler(req):
+    """异步版 /api/chat：非阻塞中转Ollama的NDJSON流"""
+    if req.method == "OPTIONS":
+        return web.Response(headers=ASYNC_CORS_HEADERS)
+    
+    try:
+        request_data = await req.json()
+    except Exception:
+        request_data = None
+    if not request_data:
+        return web.json_response({"error": "请求数据为空"}, status=400, headers=ASYNC_CORS_HEADERS)
+    
+    allowed, retry_after = rate_limiter.try_acquire("chat", request_data.get("user_id") or req.remote or "anonymous")
+    if not allowed:
+        return web.json_response({"error": "请求过于频繁，请稍后重试", "retry_after": retry_after}, status=429,
+                                 headers={"Retry-After": str(retry_after), **ASYNC_CORS_HEADERS})
+    
+    history_key, messages, ollama_request = build_chat_request(request_data)
+    try:
+        granted_at = await acquire_model_slot_async(PRIORITY_INTERACTIVE, history_key)
+    except SchedulerFullError as e:
+        return web.json_response({"error": str(e), "retry_after": e.retry_after}, status=429,
+                                 headers={"Retry-After": str(e.retry_after), **ASYNC_CORS_HEADERS})
+    backend = pick_chat_backend(history_key, ollama_request["model"])
+    backend.begin()
+    try:
+        return await _async_relay_chat(req, backend, history_key, messages, ollama_request)
+    finally:
+        backend.end()
+        model_scheduler.release(granted_at)
+
+async def _async_relay_chat(req, backend, history_key, messages, ollama_request):
+    session = req.app["ollama_session"]
+    timeout = aiohttp.ClientTimeout(sock_connect=OLLAMA_CONNECT_TIMEOUT, sock_read=OLLAMA_CHAT_TIMEOUT)
+    
+    try:
+        upstream = await session.post(backend.chat_url, json=ollama_request, timeout=timeout)
+    except aiohttp.ClientConnectionError as e:
+        ollama_pool.mark_failed(backend, e)
+        return web.json_response({"error": "无法连接到 Ollama 服务，请检查 11434 端口是否运行"}, status=503, headers=ASYNC_CORS_HEADERS)
+    except asyncio.TimeoutError:
+        return web.json_response({"error": "Ollama 响应超时，请重试"}, status=504, headers=ASYNC_CORS_HEADERS)
+    
+    async with upstream:
+        # 非流式请求：整体转发
+        if not ollama_request["stream"]:
+            if upstream.status != 200:
+                return web.json_response({"error": f"Ollama 服务错误: {upstream.status}"}, status=upstream.status, headers=ASYNC_CORS_HEADERS)
+            result = json.loads(await upstream.read())
+            assistant_reply = result.get("message", {}).get("content", "")
+            record_prompt_eval(history_key, messages, result, assistant_reply)
+            save_conversation_history(history_key, messages[-1]["content"], assistant_reply)
+            return web.json_response({
+                "response": assistant_reply,
+                "model": ollama_request["model"],
+                "done": True
+            }, headers=ASYNC_CORS_HEADERS)
+        
+        # 流式请求：逐行中转
+        response = web.StreamResponse(headers={"Content-Type": "application/json", **ASYNC_CORS_HEADERS})
+        await response.prepare(req)
+        async_stream_state["open_streams"] += 1
+        async_stream_state["total_streams"] += 1
+        raw_parts = []
+        try:
+            # 直通中转：收到多少字节就转发多少，不按行切分、不解析
+            async for chunk in upstream.content.iter_any():
+                raw_parts.append(chunk)
+                await response.write(chunk)
+        finally:
+            # 客户端提前断开时任务被取消，上游连接随 async with 归还
+            async_stream_state["open_streams"] -= 1
+        
+        await response.write_eof()
+    
+    save_streamed_reply(history_key, messages, raw_parts)
+    return response
+
+async def async_stream_updates_handler(req):
+    """异步版 SSE 更新推送（不占用线程）"""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **ASYNC_CORS_HEADERS})
+    await response.prepare(req)
+    last_count = 0
+    while True:
+        await asyncio.sleep(2)
+        current_count = len(VSCODE_AUTO_ANALYSIS_CACHE)
+        if current_count != last_count:
+            last_count = current_count
+            payload = json.dumps({'analyses_count': current_count, 'timestamp': datetime.now().isoformat()})
+            await response.write(f"data: {payload}\n\n".encode('utf-8'))
+
+async def _async_on_startup(async_app):
+    connector = aiohttp.TCPConnector(limit=ASYNC_MAX_UPSTREAM, keepalive_timeout=60)
+    async_app["ollama_session"] = aiohttp.ClientSession(connector=connector)
+
+async def _async_on_cleanup(async_app):
+    await async_app["ollama_session"].close()
+
+def start_async_stream_server(host='0.0.0.0', port=ASYNC_STREAM_PORT):
+    """在独立线程的事件循环中启动异步流式服务"""
+    if not ASYNC_STREAM_ENABLED:
+        return None
+    if aiohttp is None:
+        print("⚠️ 未安装 aiohttp，异步流式服务未启用（pip install aiohttp）")
+        return None
+    
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        async_app = web.Application()
+        async_app.on_startup.append(_async_on_startup)
+        async_app.on_cleanup.append(_async_on_cleanup)
+        async_app.router.add_route("POST", "/api/chat", async_chat_handler)
+        async_app.router.add_route("OPTIONS", "/api/chat", async_chat_handler)
+        async_app.router.add_get("/api/vscode/stream_updates", async_stream_updates_handler)
+        
+        runner = web.AppRunner(async_app)
+        loop.run_until_complete(runner.setup())
+        try:
+            loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        except OSError as e:
+            print(f"❌ 异步流式服务启动失败: {str(e)}")
+            return
+        async_stream_state["running"] = True
+        async_stream_state["port"] = port
+        try:
+            loop.run_forever()
+        finally:
+            async_stream_state["running"] = False
+            loop.run_until_complete(runner.cleanup())
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
 # ========== 获取本地IP ==========
 def get_local_ip():
     """自动获取局域网IP"""
@@ -1099,11 +3478,26 @@ def health_check():
         "auto_analyses": len(VSCODE_AUTO_ANALYSIS_CACHE),
         "local_ip": LOCAL_IP,
         "ollama_url": OLLAMA_CHAT_URL,
-        "model": OLLAMA_MODEL_NAME
+        "model": OLLAMA_MODEL_NAME,
+        "ollama_backends": ollama_pool.stats(),
+        "async_stream": async_stream_state,
+        "prompt_cache": get_prompt_cache_stats(),
+        "analysis_cache": analysis_cache.stats(),
+        "analysis_single_flight": analysis_flights.stats(),
+        "code_versions": code_version_history.stats(),
+        "model_tiers": get_model_tier_stats(),
+        "analysis_jobs": analysis_jobs.stats(),
+        "long_poll": status_notifier.stats(),
+        "logging": app_logger.stats(),
+        "code_artifacts": code_artifact_cache_stats(),
+        "code_safety": code_safety_stats(),
+        "model_scheduler": model_scheduler.stats(),
+        "rate_limits": rate_limiter.stats()
     }), 200
 
 # ========== 核心修改：只在有标签时分析，否则直接拒绝 ==========
 @app.route('/api/code/analyze', methods=['POST'])
+@rate_limited("analyze")
 def analyze_code_api():
     """智能代码分析API：只在检测到标签时进行分析，否则直接拒绝"""
     try:
@@ -1114,22 +3508,43 @@ def analyze_code_api():
         if not code:
             return jsonify({"error": "未提供代码"}), 400
         
-        print(f"📋 收到代码分析请求，代码长度: {len(code)}")
+        log_event("INFO", "analyze", f"📋 收到代码分析请求，代码长度: {len(code)}")
         
         # 智能检测标签
-        detection_result = smart_detect_markers(code)
-        print(f"🔍 检测结果: {detection_result['message']}")
+        artifact = get_code_artifact(code)
+        detection_result = artifact.detection
+        log_event("INFO", "markers", f"🔍 检测结果: {detection_result['message']}")
         
         # 情况1：有完整标签且有有效代码片段 -> 分析
         if detection_result["found_markers"] and detection_result["is_valid_snippet"]:
-            print(f"✅ 检测到有效代码片段，开始分析")
+            log_event("INFO", "analyze", "✅ 检测到有效代码片段，开始分析")
             extracted_code = detection_result["extracted_code"]
+            static_metrics = artifact.target.static_metrics
+            
+            # 流式模式：边生成边返回（超大代码需分块汇总、多个区域需分别分析，走普通模式）
+            multi_region = len(detection_result["regions"]) > 1
+            if wants_stream() and not multi_region and not (analysis_type == "explain" and needs_map_reduce(extracted_code)):
+                stream_type, prompt, cache_code = build_analysis_prompt(
+                    extracted_code, analysis_type, {"static_metrics": static_metrics})
+                return stream_analysis_response(
+                    prompt, stream_type, cache_code, PRIORITY_MANUAL, data.get("user_id", "anonymous"),
+                    extra={"code_preview": extracted_code[:200] + ("..." if len(extracted_code) > 200 else ""),
+                           "analysis_performed": True,
+                           "static_metrics": static_metrics},
+                    model=model_for_route("analyze")
+                )
             
             # 分析代码（使用对应类型的提示词）
-            analysis_result = analyze_code(extracted_code, analysis_type)
+            if multi_region:
+                _, analysis_result = analyze_regions(detection_result["regions"], analysis_type,
+                                                     user_id=data.get("user_id", "anonymous"), model=model_for_route("analyze"))
+            else:
+                analysis_result = analyze_code(extracted_code, analysis_type, {"static_metrics": static_metrics},
+                                               user_id=data.get("user_id", "anonymous"), model=model_for_route("analyze"))
             
             return jsonify({
                 "analysis": analysis_result,
+                "static_metrics": static_metrics,
                 "detection": detection_result,
                 "code_preview": extracted_code[:200] + ("..." if len(extracted_code) > 200 else ""),
                 "analysis_performed": True,
@@ -1138,7 +3553,7 @@ def analyze_code_api():
             
         # 情况2：有标签但标记之间没有代码内容
         elif detection_result["found_markers"] and not detection_result["is_valid_snippet"]:
-            print(f"⚠️ 检测到标签但无代码内容")
+            log_event("WARNING", "analyze", "⚠️ 检测到标签但无代码内容")
             
             return jsonify({
                 "analysis": "⚠️ 检测到标签但标记之间没有代码内容，请在 #***start***# 和 #***end***# 之间添加要分析的代码。",
@@ -1150,7 +3565,7 @@ def analyze_code_api():
             
         # 情况3：没有标签或标签不完整 -> 直接拒绝分析
         else:
-            print(f"❌ 未检测到完整标签，拒绝分析")
+            log_event("WARNING", "analyze", "❌ 未检测到完整标签，拒绝分析")
             
             return jsonify({
                 "analysis": f"❌ {detection_result['message']}\n\n💡 使用方法：在代码中使用 #***start***# 和 #***end***# 标记包围要分析的代码片段。",
@@ -1160,14 +3575,18 @@ def analyze_code_api():
                 "timestamp": datetime.now().isoformat()
             }), 200
         
+    except SchedulerFullError as e:
+        return busy_response(e)
+    except (OllamaBusyError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        return ollama_error_response(e)
     except Exception as e:
         error_msg = f"代码分析失败: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        log_event("ERROR", "api", error_msg, traceback=traceback.format_exc())
         return jsonify({"error": error_msg}), 500
 
 # ========== 以下是其他所有功能（保持不变） ==========
 @app.route('/api/code/execute', methods=['POST'])
+@rate_limited("execute")
 def execute_code_api():
     """执行代码并在关键点进行分析"""
     try:
@@ -1179,13 +3598,13 @@ def execute_code_api():
             return jsonify({"error": "未提供代码"}), 400
         
         # 生成执行ID
-        execution_id = f"exec_{int(time.time())}_{hashlib.md5(code.encode()).hexdigest()[:8]}"
+        execution_id = f"exec_{int(time.time())}_{get_code_artifact(code).short_id}"
         
         # 添加到执行队列
         code_execution_queue.put((execution_id, code, user_id))
         
         # 进行静态分析
-        static_analysis = analyze_code(code, "explain")
+        static_analysis = analyze_code(code, "explain", user_id=user_id, model=model_for_route("analyze"))
         
         return jsonify({
             "execution_id": execution_id,
@@ -1194,15 +3613,19 @@ def execute_code_api():
             "timestamp": datetime.now().isoformat()
         }), 202
         
+    except SchedulerFullError as e:
+        return busy_response(e)
     except Exception as e:
         error_msg = f"代码执行失败: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        log_event("ERROR", "api", error_msg, traceback=traceback.format_exc())
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/code/result/<execution_id>', methods=['GET'])
 def get_execution_result(execution_id):
-    """获取代码执行结果"""
+    """获取代码执行结果（?wait=<秒> 时等待结果产生后再返回）"""
+    wait = requested_wait()
+    if wait and execution_id not in execution_results:
+        status_notifier.wait(execution_id, lambda: execution_id in execution_results, wait)
     if execution_id not in execution_results:
         return jsonify({"error": "执行结果不存在或已过期"}), 404
     
@@ -1210,6 +3633,7 @@ def get_execution_result(execution_id):
     return jsonify(result), 200
 
 @app.route('/api/code/compare', methods=['POST'])
+@rate_limited("analyze")
 def compare_code_api():
     """比较两段代码"""
     try:
@@ -1220,27 +3644,23 @@ def compare_code_api():
         if not code_a or not code_b:
             return jsonify({"error": "需要提供两段代码"}), 400
         
-        comparison_prompt = CODE_ANALYSIS_PROMPTS["comparison"].format(
-            code_a=code_a, 
-            code_b=code_b
-        )
+        # 两段代码各占一半预算（超出时压缩、截断）
+        _, comparison_prompt, cache_code = build_analysis_prompt(
+            code_a, "comparison", {"code_a": code_a, "code_b": code_b})
+        
+        if wants_stream():
+            return stream_analysis_response(
+                comparison_prompt, "comparison", cache_code,
+                PRIORITY_MANUAL, data.get("user_id", "anonymous"), model=model_for_route("compare")
+            )
         
         try:
-            response = requests.post(
-                OLLAMA_CHAT_URL,
-                json={
-                    "model": OLLAMA_MODEL_NAME,
-                    "messages": [{"role": "user", "content": comparison_prompt}],
-                    "stream": False
-                },
-                timeout=30
+            success, comparison_result = request_model_analysis(
+                comparison_prompt, "comparison", cache_code,
+                PRIORITY_MANUAL, data.get("user_id", "anonymous"), model_for_route("compare")
             )
-            
-            if response.status_code == 200:
-                result = response.json()
-                comparison_result = result.get("message", {}).get("content", "比较失败")
-            else:
-                comparison_result = f"模型调用失败: {response.status_code}"
+        except SchedulerFullError:
+            raise
         except Exception as e:
             comparison_result = f"比较分析时出错: {str(e)}"
         
@@ -1249,13 +3669,17 @@ def compare_code_api():
             "timestamp": datetime.now().isoformat()
         }), 200
         
+    except SchedulerFullError as e:
+        return busy_response(e)
+    except (OllamaBusyError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        return ollama_error_response(e)
     except Exception as e:
         error_msg = f"代码比较失败: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        log_event("ERROR", "api", error_msg, traceback=traceback.format_exc())
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/vscode/auto_analyze', methods=['POST'])
+@rate_limited("auto_analyze")
 def vscode_auto_analyze():
     """VSCode自动代码分析接口"""
     try:
@@ -1268,17 +3692,13 @@ def vscode_auto_analyze():
         if not code or not user_id:
             return jsonify({"error": "缺少必要参数"}), 400
         
-        print(f"📤 收到VSCode自动上传: {filename} (触发方式: {trigger_type})")
+        log_event("INFO", "auto_analyze", f"📤 收到VSCode自动上传: {filename} (触发方式: {trigger_type})")
         
         # 生成分析ID
-        analysis_id = f"auto_{int(time.time())}_{hashlib.md5(code.encode()).hexdigest()[:8]}"
+        analysis_id = f"auto_{int(time.time())}_{get_code_artifact(code).short_id}"
         
-        # 异步进行处理
-        threading.Thread(
-            target=process_auto_upload_analysis,
-            args=(analysis_id, code, user_id, filename, trigger_type),
-            daemon=True
-        ).start()
+        # 放入持久化任务队列，由固定的工作线程处理
+        analysis_jobs.submit(analysis_id, code, user_id, filename, trigger_type)
         
         return jsonify({
             "analysis_id": analysis_id,
@@ -1289,19 +3709,87 @@ def vscode_auto_analyze():
         
     except Exception as e:
         error_msg = f"自动分析失败: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        log_event("ERROR", "api", error_msg, traceback=traceback.format_exc())
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/vscode/auto_status/<analysis_id>', methods=['GET'])
 def get_auto_analysis_status(analysis_id):
-    """获取自动分析状态"""
+    """
+    获取自动分析状态
+    ?wait=<秒>：状态与 ?status=（客户端上次看到的状态，默认为当前状态）不同或超时后才返回
+    """
     if analysis_id not in VSCODE_AUTO_ANALYSIS_CACHE:
         return jsonify({"error": "分析ID不存在"}), 404
     
-    result = VSCODE_AUTO_ANALYSIS_CACHE[analysis_id]
+    wait = requested_wait()
+    if wait:
+        known_status = request.args.get("status", VSCODE_AUTO_ANALYSIS_CACHE[analysis_id].get("status"))
+        if known_status not in ANALYSIS_JOB_FINAL_STATUSES:
+            status_notifier.wait(
+                analysis_id,
+                lambda: VSCODE_AUTO_ANALYSIS_CACHE.get(analysis_id, {}).get("status") != known_status,
+                wait
+            )
+    
+    result = VSCODE_AUTO_ANALYSIS_CACHE.get(analysis_id)
+    if result is None:
+        return jsonify({"error": "分析ID不存在"}), 404
     return jsonify(result), 200
 
+BATCH_STATUS_MAX_IDS = 100  # 批量状态接口一次最多查询的ID数
+
+def analysis_status_summary(analysis_id):
+    """批量状态接口中单个分析的精简状态（详情用 analysis_detail 获取）"""
+    record = VSCODE_AUTO_ANALYSIS_CACHE.get(analysis_id)
+    if record is None:
+        return {"status": "not_found"}
+    summary = {key: record.get(key) for key in ("status", "filename", "trigger_type", "analysis_type", "error")}
+    if record.get("status") in ANALYSIS_JOB_FINAL_STATUSES:
+        analysis = record.get("analysis") or ""
+        summary["analysis_preview"] = analysis[:200] + ("..." if len(analysis) > 200 else "")
+    return summary
+
+def execution_status_summary(execution_id):
+    if execution_id not in execution_results:
+        return {"status": "pending"}
+    return dict(execution_results[execution_id], status="completed")
+
+@app.route('/api/vscode/batch_status', methods=['POST'])
+def get_batch_status():
+    """
+    一次查询多个分析/执行的状态
+    请求: {"analysis_ids": [...], "execution_ids": [...], "known": {id: 客户端上次看到的状态}}
+    ?wait=<秒>：所有ID的状态都与 known 相同时等待，任一变化或超时后返回
+    """
+    data = request.get_json(silent=True) or {}
+    analysis_ids = list(dict.fromkeys(data.get("analysis_ids") or []))
+    execution_ids = list(dict.fromkeys(data.get("execution_ids") or []))
+    known = data.get("known") or {}
+    if len(analysis_ids) + len(execution_ids) > BATCH_STATUS_MAX_IDS:
+        return jsonify({"error": f"一次最多查询 {BATCH_STATUS_MAX_IDS} 个ID"}), 400
+    
+    def collect():
+        return (
+            {analysis_id: analysis_status_summary(analysis_id) for analysis_id in analysis_ids},
+            {execution_id: execution_status_summary(execution_id) for execution_id in execution_ids}
+        )
+    
+    def changed():
+        analyses, executions = collect()
+        return any(item["status"] != known.get(item_id)
+                   for item_id, item in list(analyses.items()) + list(executions.items()))
+    
+    wait = requested_wait()
+    if wait and (analysis_ids or execution_ids):
+        status_notifier.wait(analysis_ids + execution_ids, changed, wait)
+    
+    analyses, executions = collect()
+    return jsonify({
+        "analyses": analyses,
+        "executions": executions,
+        "timestamp": datetime.now().isoformat()
+    }), 200
+
 @app.route('/api/vscode/recent_analyses', methods=['GET'])
 def get_recent_analyses():
     """获取最近的分析记录"""
@@ -1334,16 +3822,26 @@ def get_recent_analyses():
         
     except Exception as e:
         error_msg = f"获取分析记录失败: {str(e)}"
-        print(error_msg)
+        log_event("ERROR", "api", error_msg)
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/vscode/analysis_detail/<analysis_id>', methods=['GET'])
 def get_analysis_detail(analysis_id):
-    """获取分析详情"""
+    """获取分析详情（?wait=<秒> 时等待分析结束后再返回）"""
     if analysis_id not in VSCODE_AUTO_ANALYSIS_CACHE:
         return jsonify({"error": "分析ID不存在"}), 404
     
-    result = VSCODE_AUTO_ANALYSIS_CACHE[analysis_id]
+    wait = requested_wait()
+    if wait:
+        status_notifier.wait(
+            analysis_id,
+            lambda: VSCODE_AUTO_ANALYSIS_CACHE.get(analysis_id, {}).get("status") in ANALYSIS_JOB_FINAL_STATUSES,
+            wait
+        )
+    
+    result = VSCODE_AUTO_ANALYSIS_CACHE.get(analysis_id)
+    if result is None:
+        return jsonify({"error": "分析ID不存在"}), 404
     
     if result.get("status") not in ["completed", "skipped", "failed"]:
         return jsonify({"error": "分析未完成"}), 400
@@ -1380,7 +3878,7 @@ def get_runtime_analyses():
         
     except Exception as e:
         error_msg = f"获取运行时分析失败: {str(e)}"
-        print(error_msg)
+        log_event("ERROR", "api", error_msg)
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/vscode/connect', methods=['POST'])
@@ -1414,8 +3912,7 @@ def vscode_connect():
         
     except Exception as e:
         error_msg = f"VSCode连接失败: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        log_event("ERROR", "api", error_msg, traceback=traceback.format_exc())
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/vscode/disconnect', methods=['POST'])
@@ -1443,10 +3940,11 @@ def vscode_disconnect():
         
     except Exception as e:
         error_msg = f"VSCode断开连接失败: {str(e)}"
-        print(error_msg)
+        log_event("ERROR", "api", error_msg)
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/vscode/runtest', methods=['POST'])
+@rate_limited("execute")
 def vscode_run_test():
     """VSCode运行代码测试接口"""
     try:
@@ -1458,13 +3956,13 @@ def vscode_run_test():
             return jsonify({"error": "缺少代码内容"}), 400
         
         # 生成执行ID
-        execution_id = f"vscode_test_{int(time.time())}_{hashlib.md5(code.encode()).hexdigest()[:8]}"
+        execution_id = f"vscode_test_{int(time.time())}_{get_code_artifact(code).short_id}"
         
         # 添加到执行队列
         code_execution_queue.put((execution_id, code, user_id))
         
         # 自动分析代码
-        analysis = analyze_code(code, "explain")
+        analysis = analyze_code(code, "explain", user_id=user_id, model=model_for_route("analyze"))
         
         return jsonify({
             "execution_id": execution_id,
@@ -1473,13 +3971,15 @@ def vscode_run_test():
             "timestamp": datetime.now().isoformat()
         }), 202
         
+    except SchedulerFullError as e:
+        return busy_response(e)
     except Exception as e:
         error_msg = f"VSCode测试运行失败: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        log_event("ERROR", "api", error_msg, traceback=traceback.format_exc())
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/vscode/analyze_latest', methods=['POST'])
+@rate_limited("analyze")
 def vscode_analyze_latest():
     """分析VSCode中最近修改的代码"""
     try:
@@ -1496,7 +3996,7 @@ def vscode_analyze_latest():
             return jsonify({"error": "未找到最近修改的代码"}), 404
         
         # 分析代码
-        analysis = analyze_code(latest_code['code'], "explain")
+        analysis = analyze_code(latest_code['code'], "explain", user_id=user_id, model=model_for_route("analyze"))
         
         return jsonify({
             "analysis": analysis,
@@ -1505,12 +4005,15 @@ def vscode_analyze_latest():
             "code_preview": latest_code['code'][:500] + ("..." if len(latest_code['code']) > 500 else "")
         }), 200
         
+    except SchedulerFullError as e:
+        return busy_response(e)
     except Exception as e:
         error_msg = f"分析最近代码失败: {str(e)}"
-        print(error_msg)
+        log_event("ERROR", "api", error_msg)
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/vscode/debug', methods=['POST'])
+@rate_limited("analyze")
 def vscode_debug():
     """VSCode调试模式分析"""
     try:
@@ -1523,21 +4026,33 @@ def vscode_debug():
         if not user_id or not code:
             return jsonify({"error": "缺少必要参数"}), 400
         
+        # 流式模式：边生成边返回
+        if wants_stream():
+            analysis_type, prompt, cache_code = build_analysis_prompt(code, "debug", {
+                "error": error_message,
+                "stack_trace": stack_trace
+            })
+            return stream_analysis_response(prompt, analysis_type, cache_code, PRIORITY_MANUAL, user_id,
+                                            model=model_for_route("debug"))
+        
         # 使用debug分析
         analysis_result = analyze_code(code, "debug", {
             "error": error_message,
             "stack_trace": stack_trace
-        })
+        }, user_id=user_id, model=model_for_route("debug"))
         
         return jsonify({
             "debug_analysis": analysis_result,
             "timestamp": datetime.now().isoformat()
         }), 200
         
+    except SchedulerFullError as e:
+        return busy_response(e)
+    except (OllamaBusyError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        return ollama_error_response(e)
     except Exception as e:
         error_msg = f"调试分析失败: {str(e)}"
-        print(error_msg)
-        traceback.print_exc()
+        log_event("ERROR", "api", error_msg, traceback=traceback.format_exc())
         return jsonify({"error": error_msg}), 500
 
 @app.route('/api/vscode/status', methods=['GET'])
@@ -1590,7 +4105,7 @@ def vscode_status():
             
     except Exception as e:
         error_msg = f"获取监控状态失败: {str(e)}"
-        print(error_msg)
+        log_event("ERROR", "api", error_msg)
         return jsonify({"error": error_msg}), 500
 
 # ========== 静态文件服务 ==========
@@ -1646,8 +4161,8 @@ if __name__ == '__main__':
     print("=" * 60)
     print(f"📁 服务根目录: {os.path.abspath(HTML_FOLDER)}")
     print(f"🌐 访问地址: http://{LOCAL_IP}:5000")
-    print(f"🤖 Ollama服务: {OLLAMA_CHAT_URL}")
-    print(f"📊 模型: {OLLAMA_MODEL_NAME}")
+    print(f"🤖 Ollama服务: {', '.join(OLLAMA_BACKENDS)}")
+    print(f"📊 模型: {OLLAMA_MODEL_NAME}（保存触发等轻量分析: {OLLAMA_SMALL_MODEL_NAME}）")
     print(f"🕐 服务器时间: {now_local.strftime('%Y-%m-%d %H:%M:%S')}")
     print()
     print("📋 可用页面:")
@@ -1673,4 +4188,8 @@ if __name__ == '__main__':
     print("✅ 所有其他功能保持不变")
     print("=" * 60)
     
+    # 启动异步流式服务（聊天流不再占用Flask线程）
+    if start_async_stream_server():
+        print(f"⚡ 异步流式聊天: http://{LOCAL_IP}:{ASYNC_STREAM_PORT}/api/chat")
+    
     app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
\ No newline at end of file
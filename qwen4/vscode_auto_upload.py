@@ -14,6 +14,107 @@ import signal
 import traceback
 from typing import Optional, Dict, Any
 
+STATUS_LONG_POLL_WAIT = 10  # 状态接口长轮询等待时间（秒），服务端在状态变化时立即返回；新提交的ID在登记时先立即查询一次
+ANALYSIS_WAIT_TIMEOUT = 60   # 等待单个分析完成的最长时间（秒）
+EXECUTION_WAIT_TIMEOUT = 60  # 等待单个执行结果的最长时间（秒）
+
+class StatusPoller:
+    """
+    状态轮询器：一个后台线程跟踪所有未完成的分析/执行ID，
+    每轮用一次批量长轮询请求查询全部ID（替代每次上传启动一个监控线程）
+    新登记的ID先立即查询一次，已完成的结果（如缓存命中）不必等当前这轮长轮询结束
+    （pycharm_test.py 中有同样的实现，修改时两处保持一致）
+    """
+    def __init__(self, server_url):
+        self.server_url = server_url
+        self.pending = {}  # id -> {"kind", "deadline", "status", "callback"}
+        self.condition = threading.Condition()
+        self.thread = None
+    
+    def track(self, item_id, kind, callback, timeout):
+        """
+        kind: "analysis" 或 "execution"
+        callback(item_id, status_data) 返回 True 表示已结束、不再跟踪；超时时 status_data 为 None
+        """
+        item = {
+            "kind": kind,
+            "deadline": time.time() + timeout,
+            "status": None,
+            "callback": callback
+        }
+        with self.condition:
+            self.pending[item_id] = item
+            self.condition.notify()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        # 立即查询一次（不等待），之后的状态变化由后台线程长轮询
+        data = self._query({item_id: item}, wait=0)
+        if data is not None:
+            self._apply(data)
+    
+    def _query(self, items, wait):
+        """批量查询状态，失败时返回 None"""
+        payload = {
+            "analysis_ids": [i for i, item in items.items() if item["kind"] == "analysis"],
+            "execution_ids": [i for i, item in items.items() if item["kind"] == "execution"],
+            "known": {i: item["status"] for i, item in items.items() if item["status"]}
+        }
+        try:
+            response = requests.post(
+                f"{self.server_url}/api/vscode/batch_status",
+                params={"wait": wait},
+                json=payload,
+                timeout=wait + 10
+            )
+            if not response.ok:
+                return None
+            return response.json()
+        except Exception:
+            return None
+    
+    def _apply(self, data):
+        """对状态有变化的ID调用回调；先记录新状态，避免两个线程重复回调同一状态"""
+        updates = list(data.get("analyses", {}).items()) + list(data.get("executions", {}).items())
+        for item_id, status_data in updates:
+            status = status_data.get("status")
+            with self.condition:
+                item = self.pending.get(item_id)
+                if item is None or status == item["status"]:
+                    continue
+                item["status"] = status
+            try:
+                done = item["callback"](item_id, status_data)
+            except Exception as e:
+                print(f"⚠️ 处理状态更新出错: {str(e)}")
+                done = True
+            if done:
+                with self.condition:
+                    if self.pending.get(item_id) is item:
+                        del self.pending[item_id]
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                now = time.time()
+                expired = [(item_id, item) for item_id, item in self.pending.items() if item["deadline"] <= now]
+                for item_id, _ in expired:
+                    del self.pending[item_id]
+                snapshot = dict(self.pending)
+            
+            for item_id, item in expired:
+                item["callback"](item_id, None)
+            if not snapshot:
+                continue
+            
+            data = self._query(snapshot, STATUS_LONG_POLL_WAIT)
+            if data is None:
+                time.sleep(2)
+                continue
+            self._apply(data)
+
 class VSCodeAutoUploadClient:
     def __init__(self, server_url="http://192.168.40.171:5000", user_id="wjx_228"):
         """
@@ -28,6 +129,7 @@ class VSCodeAutoUploadClient:
         
         self.running = False
         self.connected = False
+        self.status_poller = StatusPoller(server_url)
         
         # 创建日志目录
         self.log_dir = Path.home() / ".vscode_auto_upload"
@@ -144,12 +246,8 @@ class VSCodeAutoUploadClient:
             print(f"   分析ID: {analysis_id}")
             print(f"   状态: {message}")
             
-            # 后台监控分析进度
-            threading.Thread(
-                target=self.monitor_analysis_progress,
-                args=(analysis_id, filename),
-                daemon=True
-            ).start()
+            # 交给统一的状态轮询线程跟踪分析进度
+            self.monitor_analysis_progress(analysis_id, filename)
             
             return analysis_id
             
@@ -159,46 +257,34 @@ class VSCodeAutoUploadClient:
             return None
     
     def monitor_analysis_progress(self, analysis_id, filename):
-        """监控分析进度"""
-        max_attempts = 30
-        for attempt in range(max_attempts):
-            time.sleep(2)
+        """登记到状态轮询线程，状态变化时打印进度"""
+        start_time = time.time()
+        
+        def on_status(item_id, status_data):
+            if status_data is None:
+                print(f"\n⚠️ 分析超时: {filename}")
+                return True
             
-            try:
-                response = requests.get(
-                    f"{self.server_url}/api/vscode/auto_status/{analysis_id}",
-                    timeout=5
-                )
-                
-                if response.status_code == 200:
-                    try:
-                        status_data = response.json()
-                    except json.JSONDecodeError:
-                        print(f"⚠️ 分析状态响应非JSON: {response.text[:100]}")
-                        continue
-                    
-                    status = status_data.get("status", "unknown")
-                    
-                    if status == "completed":
-                        print(f"\n✅ 分析完成: {filename}")
-                        print(f"   📊 查看详情: {self.server_url}/auto_analysis_dashboard.html?user_id={self.user_id}")
-                        break
-                    elif status == "failed":
-                        error_msg = status_data.get("error", "分析失败")
-                        print(f"\n❌ 分析失败 [{filename}]: {error_msg}")
-                        break
-                    elif status == "analyzing" and attempt % 5 == 0:
-                        print(f"   🔄 分析中... ({attempt*2}秒)")
-                else:
-                    if attempt == max_attempts - 1:
-                        print(f"\n⚠️ 检查状态失败: {response.status_code}")
-                    
-            except Exception as e:
-                if attempt == max_attempts - 5:
-                    print(f"\n⚠️ 监控进度异常: {str(e)}")
+            status = status_data.get("status", "unknown")
+            if status == "completed":
+                print(f"\n✅ 分析完成: {filename}")
+                print(f"   📊 查看详情: {self.server_url}/auto_analysis_dashboard.html?user_id={self.user_id}")
+                return True
+            elif status == "failed":
+                error_msg = status_data.get("error", "分析失败")
+                print(f"\n❌ 分析失败 [{filename}]: {error_msg}")
+                return True
+            elif status == "skipped":
+                print(f"\n⏭️ 未分析 [{filename}]: {status_data.get('analysis_preview', '')}")
+                return True
+            elif status == "not_found":
+                print(f"\n⚠️ 分析记录不存在: {analysis_id}")
+                return True
+            elif status == "analyzing":
+                print(f"   🔄 分析中... ({int(time.time() - start_time)}秒)")
+            return False
         
-        if attempt == max_attempts - 1:
-            print(f"\n⚠️ 分析超时: {filename}")
+        self.status_poller.track(analysis_id, "analysis", on_status, ANALYSIS_WAIT_TIMEOUT)
     
     def execute_and_analyze(self, code, filename):
         """执行代码并进行运行时分析（绑定到固定用户ID）"""
@@ -250,50 +336,39 @@ class VSCodeAutoUploadClient:
             return None
     
     def monitor_execution_result(self, execution_id, filename):
-        """监控执行结果"""
-        max_attempts = 30
-        for attempt in range(max_attempts):
-            time.sleep(2)
-            
-            try:
-                response = requests.get(
-                    f"{self.server_url}/api/code/result/{execution_id}",
-                    timeout=10
-                )
-                
-                if response.status_code == 200:
-                    try:
-                        result = response.json()
-                    except json.JSONDecodeError:
-                        print(f"⚠️ 执行结果非JSON: {response.text[:100]}")
-                        continue
-                    
-                    exec_result = result.get("result", {})
-                    
-                    if exec_result.get("success"):
-                        print(f"\n✅ 执行成功: {filename}")
-                        if exec_result.get("output"):
-                            output_preview = exec_result["output"][:500]
-                            print(f"   📝 输出预览:\n{output_preview}")
-                            if len(exec_result["output"]) > 500:
-                                print(f"   ... (完整输出请查看仪表板)")
-                    else:
-                        print(f"\n❌ 执行失败: {filename}")
-                        if exec_result.get("error"):
-                            print(f"   ❗ 错误信息:\n{exec_result['error']}")
-                    
-                    return result
-                    
-                elif response.status_code == 404 and attempt == max_attempts - 1:
-                    print(f"\n⚠️ 执行结果不存在或已过期: {execution_id}")
-                    return None
-                    
-            except Exception as e:
-                if attempt == max_attempts - 5:
-                    print(f"\n⚠️ 检查执行结果异常: {str(e)}")
+        """监控执行结果：由状态轮询线程查询，本线程等待结果"""
+        finished = threading.Event()
+        holder = {}
+        
+        def on_status(item_id, status_data):
+            if status_data is None or status_data.get("status") == "completed":
+                holder["result"] = status_data
+                finished.set()
+                return True
+            return False
+        
+        self.status_poller.track(execution_id, "execution", on_status, EXECUTION_WAIT_TIMEOUT)
+        finished.wait()
+        
+        result = holder.get("result")
+        if result is None:
+            print(f"\n⚠️ 等待执行结果超时: {filename}")
+            return None
+        
+        exec_result = result.get("result", {})
+        if exec_result.get("success"):
+            print(f"\n✅ 执行成功: {filename}")
+            if exec_result.get("output"):
+                output_preview = exec_result["output"][:500]
+                print(f"   📝 输出预览:\n{output_preview}")
+                if len(exec_result["output"]) > 500:
+                    print(f"   ... (完整输出请查看仪表板)")
+        else:
+            print(f"\n❌ 执行失败: {filename}")
+            if exec_result.get("error"):
+                print(f"   ❗ 错误信息:\n{exec_result['error']}")
         
-        print(f"\n⚠️ 等待执行结果超时: {filename}")
-        return None
+        return result
     
     def upload_single_file(self, file_path):
         """上传单个文件进行分析（仅分析，不执行）"""